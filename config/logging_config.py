@@ -0,0 +1,49 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+from config.settings import get_settings
+
+# Parent logger for the app; modules log through children such as "story_viz.create_video"
+LOGGER_NAME = "story_viz"
+
+_listener = None
+
+def setup_logging(level=None):
+    """
+    Route the app's log records through a queue to a single writer thread.
+
+    Request handlers and graph nodes only enqueue records; formatting and
+    the console write happen on the QueueListener thread. Calling this more
+    than once returns the already running listener.
+
+    Args:
+        level (str, optional): Log level name; defaults to the LOG_LEVEL setting
+
+    Returns:
+        logging.handlers.QueueListener: The started listener
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    log_queue = queue.Queue(-1)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level or get_settings().LOG_LEVEL)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, console_handler)
+    _listener.start()
+    return _listener
+
+def shutdown_logging():
+    """Write out any queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -15,14 +16,41 @@ class Settings:
         # Model settings
         self.LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.0-flash")
         self.IMAGE_MODEL = os.getenv("IMAGE_MODEL", "gemini-2.0-flash-exp-image-generation")
+        # Requests per minute allowed by the API quota (gemini-2.0-flash allows 10 on the free tier)
+        self.GENAI_REQUESTS_PER_MINUTE = int(os.getenv("GENAI_REQUESTS_PER_MINUTE", "10"))
+        
+        # Video encoding
+        # Encoder threads; 0 (the default) uses every CPU
+        self.VIDEO_THREADS = int(os.getenv("VIDEO_THREADS", "0")) or os.cpu_count() or 4
+        # libx264 by default; set to h264_nvenc on hosts with an NVIDIA encoder
+        self.VIDEO_CODEC = os.getenv("VIDEO_CODEC", "libx264")
+        # Encoder preset; empty (the default) picks the codec's fastest (ultrafast for libx264, p1 for
+        # h264_nvenc). Other encoders take their own names, e.g. 12 for libsvtav1
+        self.VIDEO_PRESET = os.getenv("VIDEO_PRESET", "")
+        
+        # Logging
+        self.LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
         
         # Directories
         self.OUTPUT_DIR = os.getenv("OUTPUT_DIR", "./output")
         self.IMAGE_OUTPUT_DIR = os.path.join(self.OUTPUT_DIR, "images")
         self.AUDIO_OUTPUT_DIR = os.path.join(self.OUTPUT_DIR, "audio")
         self.VIDEO_OUTPUT_DIR = os.path.join(self.OUTPUT_DIR, "videos")
-        
-        # Create directories if they don't exist
+
+    def ensure_directories(self):
+        """Create the output directories if they don't exist"""
         os.makedirs(self.IMAGE_OUTPUT_DIR, exist_ok=True)
         os.makedirs(self.AUDIO_OUTPUT_DIR, exist_ok=True)
-        os.makedirs(self.VIDEO_OUTPUT_DIR, exist_ok=True)
\ No newline at end of file
+        os.makedirs(self.VIDEO_OUTPUT_DIR, exist_ok=True)
+
+@lru_cache(maxsize=None)
+def get_settings():
+    """
+    Return the process-wide Settings instance.
+
+    The environment is read and the output directories are created only on
+    the first call; later calls return the cached instance.
+    """
+    settings = Settings()
+    settings.ensure_directories()
+    return settings
@@ -1,53 +1,117 @@
 from fastapi import FastAPI, Form, HTTPException, Request
-from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import asyncio
-from datetime import datetime, timedelta
-import uuid
+import heapq
+import mmap
+import os
+import re
+import secrets
+import time
 from contextlib import asynccontextmanager
-import io
-import json
+import orjson
+import sys
+import logging
 
+from config.logging_config import setup_logging, shutdown_logging
 # Import the video creation function
-from services.create_video import create_video
-
-# Function to write video file in a separate thread
-def write_video_file(video_clip, filename):
-    video_clip.write_videofile(
-        filename,
-        codec='libx264',
-        fps=24,
-        threads=4,
-        logger=None
-    )
-
-# In-memory storage for video data
+from services.create_video import create_video_async, stream_encode_video, STREAM_CHUNK_SIZE
+from services.process_log import ProcessLog
+from services.story_processor import close_models
+from config.settings import get_settings
+
+# Line-buffer console output once so log lines show up without flushing after every print
+sys.stdout.reconfigure(line_buffering=True)
+sys.stderr.reconfigure(line_buffering=True)
+
+# Send log records through a queue to one writer thread
+setup_logging()
+logger = logging.getLogger("story_viz.main")
+
+settings = get_settings()
+
+# Index of stored videos; the encoded bytes live in files under VIDEO_OUTPUT_DIR
 video_storage = {}
 
-# In-memory storage for logs
+# Reverse index so a process's video can be looked up without scanning video_storage
+process_to_video = {}
+
+# Min-heap of (expiry time, video_id) so cleanup only touches videos that have expired.
+# Times are time.monotonic() seconds, which wall-clock changes can't shift
+video_expiry_heap = []
+VIDEO_TTL = 3600.0
+# Upper bound on stored videos; the oldest is evicted early to make room for a new one
+MAX_STORED_VIDEOS = 1024
+# Seconds between expiry sweeps
+CLEANUP_INTERVAL = 300
+
+# In-memory storage for logs: a ProcessLog per process, which every log stream follows
 log_storage = {}
 
+# Min-heap of (expiry time, process_id) for finished processes' logs. A log also goes with its
+# video, but runs that fail before (or while) encoding have no video to take it along
+log_expiry_heap = []
+
+def remove_video(video_id):
+    """Drop a stored video, the logs of the process that produced it, and its file"""
+    video_info = video_storage.pop(video_id, None)
+    if video_info is not None:
+        process_to_video.pop(video_info['process_id'], None)
+        log_storage.pop(video_info['process_id'], None)
+        release_video_file(video_info)
+
+def evict_oldest_videos():
+    """Remove the videos closest to expiry until there is room for one more"""
+    while len(video_storage) >= MAX_STORED_VIDEOS and video_expiry_heap:
+        _, video_id = heapq.heappop(video_expiry_heap)
+        remove_video(video_id)
+
+def remove_stale_video_files():
+    """
+    Delete video files left behind by earlier runs of the app, e.g. after a crash.
+
+    video_storage only lives in memory, so a file it doesn't know and that hasn't been
+    written to for VIDEO_TTL seconds can never be served again. The age check keeps this
+    safe for other worker processes sharing VIDEO_OUTPUT_DIR.
+    """
+    cutoff = time.time() - VIDEO_TTL
+    with os.scandir(settings.VIDEO_OUTPUT_DIR) as entries:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext != ".mp4" or name in video_storage:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+def remove_all_videos():
+    """Close and delete every stored video's file, e.g. at shutdown"""
+    for video_info in video_storage.values():
+        close_video_file(video_info)
+    video_storage.clear()
+    process_to_video.clear()
+    video_expiry_heap.clear()
+
 # Cleanup old videos periodically
 async def cleanup_videos():
     while True:
         try:
-            current_time = datetime.now()
-            expired_keys = []
-            for video_id, video_info in video_storage.items():
-                if current_time - video_info['timestamp'] > timedelta(hours=1):
-                    expired_keys.append(video_id)
-            
-            for key in expired_keys:
-                del video_storage[key]
-                # Also clean up logs
-                if key in log_storage:
-                    del log_storage[key]
+            remove_stale_video_files()
+            current_time = time.monotonic()
+            while video_expiry_heap and video_expiry_heap[0][0] <= current_time:
+                _, video_id = heapq.heappop(video_expiry_heap)
+                remove_video(video_id)
+            while log_expiry_heap and log_expiry_heap[0][0] <= current_time:
+                _, process_id = heapq.heappop(log_expiry_heap)
+                log_storage.pop(process_id, None)
                 
         except Exception as e:
-            print(f"Error during video cleanup: {e}")
+            logger.error("Error during video cleanup: %s", e)
         
-        await asyncio.sleep(600)  # Run every 10 minutes
+        await asyncio.sleep(CLEANUP_INTERVAL)
 
 # Start background task using lifespan
 @asynccontextmanager
@@ -57,6 +121,11 @@ async def lifespan(app: FastAPI):
     yield
     # Clean up tasks on shutdown
     cleanup_task.cancel()
+    # The index of stored videos dies with the process, so their files go with it
+    remove_all_videos()
+    # Close the GenAI HTTP clients still held in the client cache
+    await close_models()
+    shutdown_logging()
 
 # Create FastAPI app with lifespan
 app = FastAPI(title="Story Visualizer Web", lifespan=lifespan)
@@ -74,18 +143,14 @@ async def read_root(request: Request):
 @app.post("/api/process")
 async def process_story(story_text: str = Form(...), api_key: str = Form(None)):
     # Generate a unique ID for this processing session
-    process_id = str(uuid.uuid4())
+    process_id = secrets.token_hex(16)
     
-    # Initialize log storage for this process
-    log_storage[process_id] = []
+    # Initialize the log for this process; each log stream gets its own copy of the messages
+    log_storage[process_id] = ProcessLog()
     
     # Add initial log message for debugging
-    log_storage[process_id].append("Process initialized. Starting story processing...")
-    print(f"[DEBUG] Process {process_id} initialized")  # Debug
-    # Force flush to ensure immediate delivery
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
+    log_storage[process_id].publish("Process initialized. Starting story processing...")
+    logger.debug("Process %s initialized", process_id)
     
     # Return the process ID immediately so frontend can start streaming logs
     # Process the video in background
@@ -94,149 +159,260 @@ async def process_story(story_text: str = Form(...), api_key: str = Form(None)):
     return {"process_id": process_id}
 
 async def process_video_async(story_text: str, process_id: str, api_key: str = None):
-    print(f"[DEBUG] Starting process_video_async for process_id: {process_id}")  # Debug
-    # Force flush to ensure immediate delivery
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
+    logger.debug("Starting process_video_async for process_id: %s", process_id)
     # Add initial log message
     if process_id in log_storage:
-        log_storage[process_id].append("Starting story processing...")
-        print("[DEBUG] Added initial log message")  # Debug
-        # Force flush to ensure immediate delivery
-        sys.stdout.flush()
-        sys.stderr.flush()
-    
-    # Small delay to ensure streaming connection is established
-    await asyncio.sleep(0.01)
+        log_storage[process_id].publish("Starting story processing...")
+        logger.debug("Added initial log message")
     
     try:
-        print("[DEBUG] Calling create_video function")  # Debug
+        logger.debug("Calling create_video function")
         # Create video from story using your function
         # Use the async version to allow event loop to continue
-        from services.create_video import create_video_async
-        video_clip = await create_video_async(story_text, process_id, log_storage, api_key)
-        print("[DEBUG] Finished create_video function")  # Debug
-        
-        # Generate video data in memory using a temporary approach
-        import tempfile
-        import os
+        scenes = await create_video_async(story_text, process_id, log_storage, api_key)
+        logger.debug("Finished create_video function")
         
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as tmpfile:
-            temp_filename = tmpfile.name
-            
-        # Write video to temporary file (run in thread to avoid blocking)
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, write_video_file, video_clip, temp_filename)
-        
-        # Read the video data from the temporary file
-        with open(temp_filename, 'rb') as f:
-            video_data = f.read()
+        # Register the video before encoding so it can be streamed while ffmpeg is still running
+        # (it is only handed out through process_to_video once the first bytes exist)
+        video_id = secrets.token_hex(16)
+        evict_oldest_videos()
+        video_path = os.path.join(settings.VIDEO_OUTPUT_DIR, f"{video_id}.mp4")
+        video_info = {
+            'path': video_path,
+            'writer': open(video_path, 'wb'),
+            'fd': None,  # Read side, for streams that follow the encode
+            'data': None,  # Read-only mmap of the file once encoding is done
+            'size': 0,  # Number of bytes written so far
+            'timestamp': time.monotonic(),
+            'process_id': process_id,  # Link video to process
+            'complete': False,
+            'failed': False,
+            'removed': False,  # Expired or failed; the file goes once the last stream closes
+            'readers': 0,  # Open streams
+            'condition': asyncio.Condition()
+        }
+        video_info['fd'] = os.open(video_path, os.O_RDONLY)
+        video_storage[video_id] = video_info
+        heapq.heappush(video_expiry_heap, (video_info['timestamp'] + VIDEO_TTL, video_id))
         
-        # Clean up the temporary file
-        os.unlink(temp_filename)
+        try:
+            async for chunk in stream_encode_video(scenes):
+                video_info['writer'].write(chunk)
+                # Flush so the chunk is visible to streams reading the file right away
+                video_info['writer'].flush()
+                video_info['size'] += len(chunk)
+                await notify_video_readers(video_info)
+                if process_id not in process_to_video:
+                    # Every scene segment is encoded before the concat sends its first byte, so
+                    # only now does the video really start; the frontend polls for this to show it
+                    process_to_video[process_id] = video_id
+            finish_video_file(video_info)
+            video_info['complete'] = True
+            process_to_video[process_id] = video_id
+        except Exception:
+            video_info['failed'] = True
+            video_storage.pop(video_id, None)
+            process_to_video.pop(process_id, None)
+            release_video_file(video_info)
+            raise
+        finally:
+            await notify_video_readers(video_info)
         
         # Debug: Check the size of video_data
-        print(f"Video data size: {len(video_data)} bytes")
-        
-        # Store video with a unique ID
-        video_id = str(uuid.uuid4())
-        video_storage[video_id] = {
-            'data': video_data,
-            'timestamp': datetime.now(),
-            'process_id': process_id  # Link video to process
-        }
+        logger.info("Video data size: %s bytes", video_info['size'])
         
         # Add a completion message to logs
         if process_id in log_storage:
-            log_storage[process_id].append("Video processing completed successfully!")
-            log_storage[process_id].append(f"Video ID: {video_id}")
-            # Force flush to ensure immediate delivery
-            import sys
-            sys.stdout.flush()
-            sys.stderr.flush()
-        
-        # Clean up the clip
-        video_clip.close()
+            log_storage[process_id].publish("Video processing completed successfully!")
+            log_storage[process_id].publish(f"Video ID: {video_id}")
         
     except Exception as e:
-        print(f"Error in process_video_async: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in process_video_async: %s", e)
         # Add error message to logs
         if process_id in log_storage:
-            log_storage[process_id].append(f"Error during processing: {str(e)}")
+            log_storage[process_id].publish(f"Error during processing: {str(e)}")
+    finally:
+        # Nothing more will be logged, so let the log streams end
+        if process_id in log_storage:
+            log_storage[process_id].finish()
+            # Keep the log for late or reconnecting streams as long as a video would be kept
+            heapq.heappush(log_expiry_heap, (time.monotonic() + VIDEO_TTL, process_id))
 
 
+def finish_video_file(video_info):
+    """Close the writer of a fully encoded video and map the file for zero-copy streaming"""
+    video_info['writer'].close()
+    if video_info['size'] > 0:
+        video_info['data'] = mmap.mmap(video_info['fd'], 0, access=mmap.ACCESS_READ)
+
+def release_video_file(video_info):
+    """Delete a removed video's file, or leave that to the last stream still reading it"""
+    video_info['removed'] = True
+    if video_info['readers'] == 0:
+        close_video_file(video_info)
+
+def close_video_file(video_info):
+    """Unmap, close and delete a video's file"""
+    if video_info['data'] is not None:
+        try:
+            video_info['data'].close()
+        except BufferError:
+            # A chunk view is still alive; the mapping is released when it is collected
+            pass
+    video_info['writer'].close()
+    if video_info['fd'] is not None:
+        os.close(video_info['fd'])
+        video_info['fd'] = None
+    try:
+        os.unlink(video_info['path'])
+    except FileNotFoundError:
+        pass
+
+async def notify_video_readers(video_info):
+    """Wake up any stream waiting for more bytes of this video"""
+    async with video_info['condition']:
+        video_info['condition'].notify_all()
+
+async def video_chunks(video_info, start=0, stop=None):
+    """
+    Yield a stored video in chunks, following it while it is still being encoded.
+
+    Args:
+        video_info: Entry from video_storage
+        start: First byte offset to send
+        stop: Offset to stop before, or None to send through the end of the video
+
+    Yields:
+        Chunks of at most STREAM_CHUNK_SIZE bytes
+    """
+    condition = video_info['condition']
+    offset = start
+    video_info['readers'] += 1
+    try:
+        while stop is None or offset < stop:
+            if offset < video_info['size']:
+                end = min(offset + STREAM_CHUNK_SIZE, video_info['size'])
+                if stop is not None:
+                    end = min(end, stop)
+                if video_info['data'] is not None:
+                    # The file is mapped once encoding is done, so hand out a zero-copy view
+                    chunk = memoryview(video_info['data'])[offset:end]
+                else:
+                    # Still encoding: read what has been written so far (served from the page cache)
+                    chunk = os.pread(video_info['fd'], end - offset, offset)
+                offset = end
+                yield chunk
+                continue
+            if video_info['complete'] or video_info['failed']:
+                break
+            async with condition:
+                await condition.wait_for(
+                    lambda: offset < video_info['size'] or video_info['complete'] or video_info['failed']
+                )
+    finally:
+        video_info['readers'] -= 1
+        if video_info['readers'] == 0 and video_info['removed']:
+            close_video_file(video_info)
+
+def parse_byte_range(range_header, size):
+    """
+    Parse a single-range HTTP Range header against a resource of `size` bytes.
+
+    Args:
+        range_header: Value of the Range header, e.g. "bytes=0-1023", "bytes=500-" or "bytes=-500"
+        size: Total size of the resource in bytes
+
+    Returns:
+        Inclusive (start, end) byte offsets, or None if the header is malformed and should be ignored
+
+    Raises:
+        HTTPException: 416 if the range is well-formed but lies outside the resource
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", range_header)
+    if not match:
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            # A last byte before the first makes the header invalid, not unsatisfiable
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+        satisfiable = start < size
+    elif last:
+        # Suffix range: the final N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+        satisfiable = int(last) > 0 and size > 0
+    else:
+        return None
+    if not satisfiable:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
 @app.get("/api/video/{video_id}")
-async def stream_video(video_id: str):
+async def stream_video(video_id: str, request: Request):
     if video_id in video_storage:
         video_info = video_storage[video_id]
-        print(f"Streaming video {video_id} with size: {len(video_info['data'])} bytes")
-        return Response(
-            content=video_info['data'], 
-            media_type="video/mp4",
-            headers={
-                "Content-Disposition": "inline; filename=story_visualization.mp4"
-            }
-        )
+        logger.info("Streaming video %s (%s bytes encoded so far)", video_id, video_info['size'])
+        headers = {"Content-Disposition": "inline; filename=story_visualization.mp4"}
+        if not video_info['complete']:
+            # Still encoding: follow the encoder, nothing is cacheable yet
+            return StreamingResponse(video_chunks(video_info), media_type="video/mp4", headers=headers)
+
+        # A finished video never changes, and its random ID already identifies the content
+        etag = f'"{video_id}"'
+        headers["ETag"] = etag
+        headers["Cache-Control"] = "private, max-age=3600, immutable"
+        if request.headers.get("if-none-match") in (etag, video_id):
+            return Response(status_code=304, headers=headers)
+
+        size = video_info['size']
+        headers["Accept-Ranges"] = "bytes"
+        range_header = request.headers.get("range")
+        # Multi-range requests are rare for media; answer them with the whole file.
+        # A malformed header is ignored as RFC 7233 requires, so it falls through to the 200 below
+        byte_range = parse_byte_range(range_header, size) if range_header and "," not in range_header else None
+        if byte_range is not None:
+            # Always 206 for a valid range: Safari refuses to play media served as 200 to "bytes=0-1"
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(video_chunks(video_info, start, end + 1), status_code=206,
+                                     media_type="video/mp4", headers=headers)
+
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(video_chunks(video_info), media_type="video/mp4", headers=headers)
     else:
         raise HTTPException(status_code=404, detail="Video not found")
 
 @app.get("/api/video/by_process/{process_id}")
 async def get_video_by_process(process_id: str):
-    # Look for a video associated with this process ID
-    for video_id, video_info in video_storage.items():
-        if video_info.get('process_id') == process_id:
-            return {"video_id": video_id}
+    # Look up the video associated with this process ID
+    video_id = process_to_video.get(process_id)
+    if video_id is not None:
+        return {"video_id": video_id}
     
     # If no video found, return 404
     raise HTTPException(status_code=404, detail="Video not ready or not found")
 
 @app.get("/api/logs/{process_id}")
-async def stream_logs(process_id: str):
+async def stream_logs(process_id: str, request: Request):
+    if process_id not in log_storage:
+        raise HTTPException(status_code=404, detail="Process not found")
+    process_log = log_storage[process_id]
+    # An EventSource reconnect names the last message it got, so only newer ones are replayed
+    last_event_id = request.headers.get("last-event-id", "")
+    after = int(last_event_id) if last_event_id.isdigit() else -1
+    
     async def log_generator():
-        print(f"[DEBUG] Starting log stream for process_id: {process_id}")  # Debug
-        # Force flush to ensure immediate delivery
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
-        sent_logs = 0
-        # Send all existing logs first
-        if process_id in log_storage:
-            logs = log_storage[process_id]
-            print(f"[DEBUG] Found {len(logs)} existing logs")  # Debug
-            # Force flush to ensure immediate delivery
-            sys.stdout.flush()
-            sys.stderr.flush()
-            for i in range(len(logs)):
-                yield f"data: {json.dumps({'message': logs[i]})}\n\n"
-                print(f"[DEBUG] Sent log: {logs[i]}")  # Debug
-                # Force flush to ensure immediate delivery
-                sys.stdout.flush()
-                sys.stderr.flush()
-            sent_logs = len(logs)
-        
-        # Then continue sending new logs as they appear
-        while True:
-            if process_id in log_storage:
-                logs = log_storage[process_id]
-                # Send new logs
-                if len(logs) > sent_logs:
-                    print(f"[DEBUG] Found {len(logs) - sent_logs} new logs")  # Debug
-                    # Force flush to ensure immediate delivery
-                    sys.stdout.flush()
-                    sys.stderr.flush()
-                    for i in range(sent_logs, len(logs)):
-                        yield f"data: {json.dumps({'message': logs[i]})}\n\n"
-                        print(f"[DEBUG] Sent new log: {logs[i]}")  # Debug
-                        # Force flush to ensure immediate delivery
-                        sys.stdout.flush()
-                        sys.stderr.flush()
-                    sent_logs = len(logs)
-            # Reduce delay for more responsive updates
-            await asyncio.sleep(0.01)  # Check for new logs every 0.01 seconds (increased frequency)
+        logger.debug("Starting log stream for process_id: %s", process_id)
+        # Replay what was logged so far, then wait for each new message instead of polling
+        async for event_id, message in process_log.subscribe(after):
+            yield b"id: %d\ndata: " % event_id + orjson.dumps({'message': message}) + b"\n\n"
+            logger.debug("Sent log: %s", message)
+        # Processing is finished; tell the client not to reconnect
+        yield b"event: end\ndata: {}\n\n"
     
     return StreamingResponse(log_generator(), media_type="text/event-stream")
 
@@ -1,5 +1,6 @@
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple, Deque
 from typing_extensions import TypedDict
+import numpy as np
 
 class SceneInfo(TypedDict):
     scene_number: int
@@ -9,12 +10,22 @@ class SceneInfo(TypedDict):
     characters_present: List[str]
     tone: str
     image_prompt: Optional[str]
-    image_base64: Optional[str]
-    audio_array: Optional[str]
+    image_bytes: Optional[bytes]  # Encoded image file (e.g. PNG) as returned by the image model
+    audio_array: Optional[Tuple[int, np.ndarray]]  # (sample_rate, samples) from the TTS model
 
 class StoryAnalysisState(TypedDict):
     story_text: str
     characters: Dict[str, Dict[str, str]]
     scenes: List[SceneInfo]
     overall_style: Optional[str]
-    processing_log: List[str]
+    processing_log: Deque[str]  # Bounded; see PROCESSING_LOG_MAXLEN
+    # Logging context carried through the graph so concurrent runs don't share globals
+    process_id: Optional[str]
+    log_storage: Optional[Dict[str, Any]]  # Mapping of process IDs to ProcessLogs
+    log_batcher: Optional[Any]  # LogBatcher delivering this run's messages to its ProcessLog
+    # Clients for this run's API key, so a concurrent request with another key can't swap them
+    genai_client: Optional[Any]
+    llm: Optional[Any]
+    # SlidingWindowLimiters for this run's API key, shared with other runs using the same key
+    llm_rate_limiter: Optional[Any]
+    image_rate_limiter: Optional[Any]
@@ -1,103 +1,120 @@
-import asyncio
-import time
-from services.story_processor import create_graph, set_process_id, set_log_storage, initialize_models
+import logging
+import threading
+from collections import deque
+from services.story_processor import create_graph, initialize_models, release_models
+from services.log_batcher import LogBatcher
 
-async def create_finalstate_async(story_text, process_id=None, log_storage=None, api_key=None):
+logger = logging.getLogger("story_viz.create_final_state")
+
+# Only the most recent processing_log entries are kept; the live log goes out through log_storage
+PROCESSING_LOG_MAXLEN = 1024
+
+# The compiled graph is request-independent; the models are resolved per run
+_graph = None
+_setup_lock = threading.Lock()
+
+def _prepare_graph(api_key, log_context):
+    """
+    Get the clients and rate limiters for `api_key` and the compiled graph, reusing both across requests.
+
+    Args:
+        api_key (str, optional): Google API key for model initialization
+        log_context (dict): Logging context passed on to initialize_models
+
+    Returns:
+        tuple: (graph, clients), where clients maps 'genai_client', 'llm' and their rate limiters for the run's state;
+        pass clients to release_models() when the run ends
+    """
+    global _graph
+    with _setup_lock:
+        logger.debug("Initializing models with api_key: %s", 'provided' if api_key else 'None')
+        clients = initialize_models(api_key, log_context)
+        logger.debug("Finished initializing models")
+        if _graph is None:
+            _graph = create_graph()
+            logger.debug("Created graph")
+        return _graph, clients
+
+async def create_finalstate_async(story_text, process_id=None, log_storage=None, api_key=None, log_batcher=None):
     """
     Create the final state of the story processing workflow asynchronously.
     
     Args:
         story_text (str): The story text to process
         process_id (str, optional): Process ID for logging
-        log_storage (dict, optional): Log storage reference
+        log_storage (dict, optional): Mapping of process IDs to ProcessLogs
         api_key (str, optional): Google API key for model initialization
+        log_batcher (LogBatcher, optional): Batcher to send log messages through; one is created if omitted
         
     Returns:
         dict: The final state of the workflow.
     """
-    print(f"[DEBUG] create_finalstate_async called with process_id: {process_id}")  # Debug
-    # Set process ID for logging if provided
-    if process_id:
-        set_process_id(process_id)
-        print(f"[DEBUG] Set process_id: {process_id}")  # Debug
-    
-    # Set log storage reference if provided
-    if log_storage:
-        set_log_storage(log_storage)
-        print("[DEBUG] Set log_storage")  # Debug
-    
-    # Initialize models with provided API key
-    print(f"[DEBUG] Initializing models with api_key: {'provided' if api_key else 'None'}")  # Debug
-    initialize_models(api_key)
-    print("[DEBUG] Finished initializing models")  # Debug
-    
-    graph = create_graph()
-    print("[DEBUG] Created graph")  # Debug
+    logger.debug("create_finalstate_async called with process_id: %s", process_id)
+    # Logging context travels with the graph state instead of module globals
+    if log_batcher is None:
+        log_batcher = LogBatcher(process_id, log_storage)
+    log_context = {"process_id": process_id, "log_storage": log_storage, "log_batcher": log_batcher}
+
+    # The graph is shared; the clients and rate limiters for this run's API key travel in its state
+    graph, clients = _prepare_graph(api_key, log_context)
 
-    initial_state = {"story_text": story_text}
-    print("[DEBUG] Created initial_state")  # Debug
+    initial_state = {"story_text": story_text, "processing_log": deque(maxlen=PROCESSING_LOG_MAXLEN),
+                     **log_context, **clients}
+    logger.debug("Created initial_state")
 
-    print("[DEBUG] Invoking graph asynchronously")  # Debug
+    logger.debug("Invoking graph asynchronously")
     # Use astream to get real-time updates
     final_state = {}
     try:
         async for chunk in graph.astream(initial_state):
             for node, state in chunk.items():
                 # Update log with completed step
-                if process_id and log_storage and process_id in log_storage:
-                    log_storage[process_id].append(f"Completed processing step: {node}")
-                    # Force flush to ensure logs are sent immediately
-                    import sys
-                    sys.stdout.flush()
-                    sys.stderr.flush()
-                final_state = {**final_state, **state}
-                # Yield control to allow event loop to process log streaming
-                await asyncio.sleep(0.01)
+                log_batcher.append(f"Completed processing step: {node}")
+                # Merge in place; nodes return only the keys they changed
+                final_state.update(state)
     except Exception as e:
-        print(f"[DEBUG] Error during graph streaming: {e}")
-        if process_id and log_storage and process_id in log_storage:
-            log_storage[process_id].append(f"Error during processing: {str(e)}")
+        logger.error("Error during graph streaming: %s", e)
+        log_batcher.append(f"Error during processing: {str(e)}")
         raise
+    finally:
+        log_batcher.flush()
+        release_models(clients)
     
-    print("[DEBUG] Graph async streaming completed")  # Debug
+    logger.debug("Graph async streaming completed")
     return final_state
 
-def create_finalstate(story_text, process_id=None, log_storage=None, api_key=None):
+def create_finalstate(story_text, process_id=None, log_storage=None, api_key=None, log_batcher=None):
     """
     Create the final state of the story processing workflow (synchronous version).
     
     Args:
         story_text (str): The story text to process
         process_id (str, optional): Process ID for logging
-        log_storage (dict, optional): Log storage reference
+        log_storage (dict, optional): Mapping of process IDs to ProcessLogs
         api_key (str, optional): Google API key for model initialization
+        log_batcher (LogBatcher, optional): Batcher to send log messages through; one is created if omitted
         
     Returns:
         dict: The final state of the workflow.
     """
-    print(f"[DEBUG] create_finalstate called with process_id: {process_id}")  # Debug
-    # Set process ID for logging if provided
-    if process_id:
-        set_process_id(process_id)
-        print(f"[DEBUG] Set process_id: {process_id}")  # Debug
-    
-    # Set log storage reference if provided
-    if log_storage:
-        set_log_storage(log_storage)
-        print("[DEBUG] Set log_storage")  # Debug
-    
-    # Initialize models with provided API key
-    print(f"[DEBUG] Initializing models with api_key: {'provided' if api_key else 'None'}")  # Debug
-    initialize_models(api_key)
-    print("[DEBUG] Finished initializing models")  # Debug
-    
-    graph = create_graph()
-    print("[DEBUG] Created graph")  # Debug
+    logger.debug("create_finalstate called with process_id: %s", process_id)
+    # Logging context travels with the graph state instead of module globals
+    if log_batcher is None:
+        log_batcher = LogBatcher(process_id, log_storage)
+    log_context = {"process_id": process_id, "log_storage": log_storage, "log_batcher": log_batcher}
 
-    initial_state = {"story_text": story_text}
-    print("[DEBUG] Created initial_state")  # Debug
+    # The graph is shared; the clients and rate limiters for this run's API key travel in its state
+    graph, clients = _prepare_graph(api_key, log_context)
 
-    print("[DEBUG] Invoking graph")  # Debug
-    final_state = graph.invoke(initial_state)
-    print("[DEBUG] Graph invocation completed")  # Debug
+    initial_state = {"story_text": story_text, "processing_log": deque(maxlen=PROCESSING_LOG_MAXLEN),
+                     **log_context, **clients}
+    logger.debug("Created initial_state")
+
+    logger.debug("Invoking graph")
+    try:
+        final_state = graph.invoke(initial_state)
+    finally:
+        log_batcher.flush()
+        release_models(clients)
+    logger.debug("Graph invocation completed")
     return final_state
\ No newline at end of file
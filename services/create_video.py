@@ -1,266 +1,320 @@
 import os
 import asyncio
-from moviepy import ImageClip, AudioArrayClip, concatenate_videoclips
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from imageio_ffmpeg import get_ffmpeg_exe
 from services.create_final_state import create_finalstate, create_finalstate_async
-import base64
-import io
+from config.settings import get_settings
 from PIL import Image
 import numpy as np
 from io import BytesIO
 
+logger = logging.getLogger("story_viz.create_video")
+
+settings = get_settings()
+
+# ffmpeg build bundled with imageio-ffmpeg (IMAGEIO_FFMPEG_EXE overrides it)
+FFMPEG_BINARY = get_ffmpeg_exe()
+
+# Output settings for the streamed MP4
+VIDEO_FPS = 24
+AUDIO_FPS = 44100
+STREAM_CHUNK_SIZE = 64 * 1024
+ENCODER_THREADS = settings.VIDEO_THREADS
+# Encoder threads per scene segment; segments are encoded side by side to fill ENCODER_THREADS
+SEGMENT_THREADS = 2
+VIDEO_CODEC = settings.VIDEO_CODEC
+VIDEO_PRESET = settings.VIDEO_PRESET
+# Frame size of the placeholder video used when no scene could be built
+FALLBACK_FRAME_SIZE = (640, 480)
+# Keep intermediate files in RAM (tmpfs) where available; None falls back to the system temp dir
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# ffmpeg raw sample formats for the sample types the TTS model can return
+PCM_FORMATS = {
+    np.dtype(np.float32): 'f32le',
+    np.dtype(np.float64): 'f64le',
+    np.dtype(np.int16): 's16le',
+    np.dtype(np.int32): 's32le',
+}
+
+# Preparing scene inputs (header parse, PCM normalization) is CPU work, so it runs here instead of
+# on the event loop. The encoding itself happens in ffmpeg child processes.
+ENCODE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='encode')
+
+def _video_codec_args(threads=ENCODER_THREADS):
+    """ffmpeg arguments selecting the configured video encoder and preset (its fastest unless VIDEO_PRESET is set)"""
+    if VIDEO_CODEC == 'h264_nvenc':
+        # NVENC runs on the GPU, so CPU threads don't apply
+        return ['-c:v', 'h264_nvenc', '-preset', VIDEO_PRESET or 'p1', '-tune', 'll']
+    if VIDEO_CODEC == 'libx264':
+        # Every segment is a single still image
+        return ['-c:v', 'libx264', '-preset', VIDEO_PRESET or 'ultrafast', '-tune', 'stillimage', '-threads', str(threads)]
+    preset_args = ['-preset', VIDEO_PRESET] if VIDEO_PRESET else []
+    return ['-c:v', VIDEO_CODEC, *preset_args, '-threads', str(threads)]
+
+def _segment_output_args(fps):
+    """Encoder arguments shared by every segment, so the segments can be joined without re-encoding"""
+    return ['-r', str(fps), *_video_codec_args(SEGMENT_THREADS), '-c:a', 'aac', '-ar', str(AUDIO_FPS), '-ac', '2']
+
+def _write_pipe(fd, data):
+    """Write `data` to the pipe `fd` and close it; a reader that already quit is reported by ffmpeg's status"""
+    try:
+        with open(fd, 'wb') as pipe:
+            pipe.write(data)
+    except BrokenPipeError:
+        pass
+
+async def _run_ffmpeg(args, input_bytes=None, pass_fds=()):
+    """
+    Run ffmpeg to completion.
+
+    Args:
+        args (list): Arguments following the ffmpeg binary
+        input_bytes (bytes, optional): Data to feed to ffmpeg's stdin (read as `pipe:0`)
+        pass_fds (tuple, optional): Pipe read ends ffmpeg reads as `pipe:<fd>`; closed here once ffmpeg has them
+
+    Raises:
+        RuntimeError: If ffmpeg exits with a non-zero status
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_BINARY, '-y', '-loglevel', 'error', *args,
+            stdin=asyncio.subprocess.DEVNULL if input_bytes is None else asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, pass_fds=pass_fds
+        )
+    finally:
+        # ffmpeg holds its own copies; closing ours lets the writers see a broken pipe if it exits early
+        for fd in pass_fds:
+            os.close(fd)
+    _, stderr = await process.communicate(input_bytes)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with status {process.returncode}: {stderr.decode(errors='replace').strip()}")
+
+def _prepare_scene(scene):
+    """
+    Check one scene and turn its narration into raw PCM for ffmpeg.
+
+    Args:
+        scene (dict): Scene from the final state, with 'image_bytes' and 'audio_array'
+
+    Returns:
+        dict: Image bytes and size, PCM bytes and format, and duration of the
+        scene, or None if the scene is missing data or cannot be used.
+    """
+    scene_num = scene.get('scene_number', 'Unknown')
+    image_bytes = scene.get('image_bytes')
+    audio_array = scene.get('audio_array')
+
+    # Skip scenes without required data
+    if not image_bytes or audio_array is None:
+        logger.warning("Missing image or audio data for scene %s. Skipping scene.", scene_num)
+        return None
+
+    sample_rate, array = audio_array
+    logger.info("Processing Scene %s...", scene_num)
+
+    try:
+        # Only the header is parsed here; ffmpeg decodes the pixels
+        with Image.open(BytesIO(image_bytes)) as image:
+            image_size = image.size
+
+        array = np.asarray(array).ravel()
+        if array.dtype not in PCM_FORMATS:
+            array = array.astype(np.float32)
+        if array.dtype.kind == 'f':
+            # Peak from min/max avoids the full-size temporary that np.abs would allocate
+            peak = max(-float(array.min()), float(array.max()))
+            if peak > 1.0:
+                array = np.multiply(array, array.dtype.type(1.0 / peak))
+
+        scene_duration = array.shape[0] / sample_rate
+        if scene_duration <= 0:
+            logger.warning("Audio duration is zero or negative for scene %s. Skipping scene.", scene_num)
+            return None
+        logger.info("Audio Duration: %.2f seconds", scene_duration)
+
+        return {
+            'scene_number': scene_num,
+            'image_bytes': image_bytes,
+            'image_size': image_size,
+            'audio_bytes': array.tobytes(),
+            'audio_format': PCM_FORMATS[array.dtype],
+            'sample_rate': sample_rate,
+            'duration': scene_duration,
+        }
+
+    except Exception as e:
+        logger.error("Error processing scene %s: %s", scene_num, e)
+        return None
+
+def _frame_size(scene_inputs):
+    """
+    Frame size that fits every scene image, rounded up to even dimensions for yuv420p.
+
+    Concat stream copy needs identical stream parameters in every segment,
+    so smaller images are centered on a black canvas of this size.
+    """
+    if not scene_inputs:
+        return FALLBACK_FRAME_SIZE
+    width = max(scene_input['image_size'][0] for scene_input in scene_inputs)
+    height = max(scene_input['image_size'][1] for scene_input in scene_inputs)
+    return width + width % 2, height + height % 2
+
+async def _encode_segment(scene_input, frame_size, segment_path, fps, limiter):
+    """
+    Encode one scene into a short MP4: its image held for the length of its narration.
+
+    Args:
+        scene_input (dict): Scene inputs from _prepare_scene
+        frame_size (tuple): Output (width, height) shared by all segments
+        segment_path (str): Where to write the segment
+        fps (int): Output frame rate
+        limiter (asyncio.Semaphore): Bounds how many segments are encoded at once
+
+    Returns:
+        str: `segment_path`, or None if ffmpeg failed
+    """
+    width, height = frame_size
+    try:
+        async with limiter:
+            # Both inputs stay in memory: the PCM goes to ffmpeg's stdin and the encoded image through
+            # a second pipe, fed from a thread. The loop filter repeats the image's single frame.
+            image_fd, image_pipe = os.pipe()
+            image_writer = asyncio.to_thread(_write_pipe, image_pipe, scene_input['image_bytes'])
+            await asyncio.gather(_run_ffmpeg([
+                '-f', 'image2pipe', '-framerate', str(fps), '-i', f'pipe:{image_fd}',
+                '-f', scene_input['audio_format'], '-ar', str(scene_input['sample_rate']), '-ac', '1',
+                '-i', 'pipe:0',
+                '-map', '0:v', '-map', '1:a', '-t', f"{scene_input['duration']:.3f}",
+                '-vf', f'loop=loop=-1:size=1,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=yuv420p',
+                *_segment_output_args(fps), segment_path,
+            ], scene_input['audio_bytes'], (image_fd,)), image_writer)
+    except Exception as e:
+        logger.error("Error encoding scene %s: %s", scene_input['scene_number'], e)
+        return None
+    logger.info("Successfully created video segment for scene %s.", scene_input['scene_number'])
+    return segment_path
+
+async def _encode_fallback_segment(frame_size, segment_path, fps):
+    """Encode one second of black video with silence, used when no scene could be built"""
+    width, height = frame_size
+    await _run_ffmpeg([
+        '-f', 'lavfi', '-i', f'color=c=black:s={width}x{height}:r={fps}:d=1',
+        '-f', 'lavfi', '-i', f'anullsrc=r={AUDIO_FPS}:cl=stereo',
+        '-t', '1', '-pix_fmt', 'yuv420p',
+        *_segment_output_args(fps), segment_path,
+    ])
+    return segment_path
+
+async def stream_encode_video(scenes, fps=VIDEO_FPS, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encode the scenes of a story to H.264 and yield the MP4 as it is produced.
+
+    Each scene is encoded by ffmpeg into its own short segment, several at a
+    time, and the segments are joined by the concat demuxer as a stream copy,
+    so the join never re-encodes. The joined output is a fragmented MP4 read from
+    ffmpeg's stdout, which browsers can play before the whole file arrives.
+
+    Args:
+        scenes (list): Scenes from the final state
+        fps (int, optional): Output frame rate
+        chunk_size (int, optional): Maximum size of each yielded chunk
+
+    Yields:
+        bytes: Consecutive chunks of the encoded MP4.
+    """
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory(prefix='story_', dir=SCRATCH_DIR) as scratch_dir:
+        prepared = await asyncio.gather(*(
+            loop.run_in_executor(ENCODE_POOL, _prepare_scene, scene) for scene in scenes
+        ))
+        scene_inputs = [scene_input for scene_input in prepared if scene_input is not None]
+        frame_size = _frame_size(scene_inputs)
+
+        # Scenes are independent, so their segments are encoded side by side; gather keeps scene order
+        limiter = asyncio.Semaphore(max(1, ENCODER_THREADS // SEGMENT_THREADS))
+        encoded = await asyncio.gather(*(
+            _encode_segment(
+                scene_input, frame_size, os.path.join(scratch_dir, f"segment_{index:03d}.mp4"), fps, limiter
+            )
+            for index, scene_input in enumerate(scene_inputs)
+        ))
+        segment_paths = [segment_path for segment_path in encoded if segment_path is not None]
+
+        if not segment_paths:
+            logger.warning("No valid scene segments were created. Using a placeholder video.")
+            segment_paths.append(
+                await _encode_fallback_segment(frame_size, os.path.join(scratch_dir, "fallback.mp4"), fps)
+            )
+
+        logger.info("Concatenating %s scene segments...", len(segment_paths))
+        concat_list_path = os.path.join(scratch_dir, "segments.txt")
+        with open(concat_list_path, 'w') as concat_list:
+            concat_list.writelines(f"file '{path}'\n" for path in segment_paths)
+
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_BINARY, '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', concat_list_path,
+            '-c', 'copy',
+            # empty_moov puts the moov atom up front, which is what faststart would do for a seekable file
+            '-movflags', '+frag_keyframe+empty_moov+default_base_moof',
+            '-f', 'mp4', 'pipe:1',
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE
+        )
+        try:
+            while True:
+                chunk = await process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            return_code = await process.wait()
+            if return_code != 0:
+                raise RuntimeError(f"ffmpeg exited with status {return_code}")
+            logger.info("Video creation process finished.")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+def _scene_list(final_state):
+    """Return the scenes of a final state, or an empty list if they are missing"""
+    scenes = final_state.get('scenes')
+    if isinstance(scenes, list):
+        return scenes
+    logger.error("'scenes' key not found or is not a list in final_state.")
+    return []
+
 async def create_video_async(story_text, process_id=None, log_storage=None, api_key=None):
+    """
+    Run the story workflow and return the scenes for stream_encode_video.
+
+    Args:
+        story_text (str): The story text to process
+        process_id (str, optional): Process ID for logging
+        log_storage (dict, optional): Mapping of process IDs to ProcessLogs
+        api_key (str, optional): Google API key for model initialization
+
+    Returns:
+        list: Scenes of the final state.
+    """
     final_state = await create_finalstate_async(story_text, process_id, log_storage, api_key)
-    # Add a small delay to ensure streaming connection is established
-    await asyncio.sleep(0.01)
-    # -----------------------------------------------------
-    
-    scene_clips = [] # To store video clips for each scene
-    
-    print("Starting video creation process...")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
-    
-    # --- Iterate through scenes and create video clips ---
-    if 'scenes' in final_state and isinstance(final_state['scenes'], list):
-        for scene in final_state['scenes']:
-            scene_num = scene.get('scene_number', 'Unknown')
-            image_base64 = scene.get('image_base64')
-            audio_array = scene.get('audio_array')
-            
-            # Skip scenes without required data
-            if not image_base64 or audio_array is None:
-                print(f"  Warning: Missing image or audio data for scene {scene_num}. Skipping scene.")
-                continue
-                
-            sample_rate, array = audio_array
-            print(f"\nProcessing Scene {scene_num}...")
-            
-            if array.dtype == np.float32:
-                if np.max(np.abs(array)) > 1.0:
-                    array = array / np.max(np.abs(array))
-            
-            try:
-                # --- Load audio to get duration ---
-                audio_clip = AudioArrayClip(np.repeat(array.reshape(-1, 1), 2, axis=1), fps=sample_rate)
-                scene_duration = audio_clip.duration
-                if scene_duration <= 0:
-                    print(f"  Warning: Audio duration is zero or negative for scene {scene_num}. Skipping scene.")
-                    audio_clip.close() # Close the clip
-                    continue
-                print(f"  Audio Duration: {scene_duration:.2f} seconds")
-                # Force flush logs to ensure they're sent immediately
-                import sys
-                sys.stdout.flush()
-                sys.stderr.flush()
-                
-                # --- Create image clip ---
-                # Set image duration to match audio duration
-                # Yield control to allow event loop to process log streaming
-                await asyncio.sleep(0.01)
-                
-                image = Image.open(BytesIO(image_base64))
-                # Convert to RGB if necessary (MoviePy works best with RGB)
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                # Convert PIL image to numpy array
-                image_array = np.array(image)
-                img_clip = ImageClip(image_array).with_duration(scene_duration)
-                
-                # --- Set audio for the image clip ---
-                video_clip = img_clip.with_audio(audio_clip)
-                
-                # Add the completed scene clip to our list
-                scene_clips.append(video_clip)
-                print(f"  Successfully created video clip for scene {scene_num}.")
-                # Force flush logs to ensure they're sent immediately
-                import sys
-                sys.stdout.flush()
-                sys.stderr.flush()
-                
-                # Yield control to allow event loop to process log streaming
-                await asyncio.sleep(0.01)
-                
-            except Exception as e:
-                print(f"  Error processing scene {scene_num}: {e}")
-                # Ensure clips are closed if an error occurs mid-processing
-                if 'audio_clip' in locals() and hasattr(audio_clip, 'close'):
-                    audio_clip.close()
-                if 'img_clip' in locals() and hasattr(img_clip, 'close'):
-                    img_clip.close()
-                if 'video_clip' in locals() and hasattr(video_clip, 'close'):
-                    video_clip.close()
-                
-    else:
-        print("Error: 'scenes' key not found or is not a list in final_state.")
-    
-    # --- Concatenate all scene clips ---
-    if scene_clips:
-        print(f"\nConcatenating {len(scene_clips)} scene clips...")
-        # Force flush logs to ensure they're sent immediately
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
-        # Yield control to allow event loop to process log streaming
-        await asyncio.sleep(0.01)
-        try:
-            print("Concatenating video clips...")
-            # Force flush logs to ensure they're sent immediately
-            sys.stdout.flush()
-            sys.stderr.flush()
-            # Yield control to allow event loop to process log streaming
-            await asyncio.sleep(0.01)
-            final_clip = concatenate_videoclips(scene_clips, method="compose")
-            # --- Cleanup: Close any remaining clips in the list ---
-            print("Cleaning up...")
-            # Force flush logs to ensure they're sent immediately
-            sys.stdout.flush()
-            sys.stderr.flush()
-            # Yield control to allow event loop to process log streaming
-            await asyncio.sleep(0.01)
-            for clip in scene_clips:
-                if hasattr(clip, 'close'):
-                    clip.close()
-            print("Video creation process finished.")
-            # Force flush logs to ensure they're sent immediately
-            sys.stdout.flush()
-            sys.stderr.flush()
-            # Yield control to allow event loop to process log streaming
-            await asyncio.sleep(0.01)
-            return final_clip
-            
-        except Exception as e:
-            print(f"Error during concatenation: {e}")
-            # Close any remaining clips on error
-            for clip in scene_clips:
-                if hasattr(clip, 'close'):
-                    clip.close()
-            raise
-    else:
-        print("No valid scene clips were created. Final video cannot be generated.")
-        # Return a simple black clip as fallback
-        from moviepy import ColorClip
-        return ColorClip(size=(640, 480), color=(0, 0, 0), duration=1)
+    logger.info("Starting video creation process...")
+    return _scene_list(final_state)
 
 def create_video(story_text, process_id=None, log_storage=None, api_key=None):
+    """
+    Synchronous version of create_video_async that also encodes the video.
+
+    Returns:
+        bytes: The complete MP4.
+    """
     final_state = create_finalstate(story_text, process_id, log_storage, api_key)
-    # -----------------------------------------------------
-
-    scene_clips = [] # To store video clips for each scene
-
-    print("Starting video creation process...")
-
-    # --- Iterate through scenes and create video clips ---
-    if 'scenes' in final_state and isinstance(final_state['scenes'], list):
-        for scene in final_state['scenes']:
-            scene_num = scene.get('scene_number', 'Unknown')
-            image_base64 = scene.get('image_base64')
-            audio_array = scene.get('audio_array')
-            
-            # Skip scenes without required data
-            if not image_base64 or audio_array is None:
-                print(f"  Warning: Missing image or audio data for scene {scene_num}. Skipping scene.")
-                continue
-                
-            sample_rate, array = audio_array
-            print(f"\nProcessing Scene {scene_num}...")
-            
-            if array.dtype == np.float32:
-                if np.max(np.abs(array)) > 1.0:
-                    array = array / np.max(np.abs(array))
-
-            try:
-                # --- Load audio to get duration ---
-                audio_clip = AudioArrayClip(np.repeat(array.reshape(-1, 1), 2, axis=1), fps=sample_rate)
-                scene_duration = audio_clip.duration
-                if scene_duration <= 0:
-                    print(f"  Warning: Audio duration is zero or negative for scene {scene_num}. Skipping scene.")
-                    audio_clip.close() # Close the clip
-                    continue
-                print(f"  Audio Duration: {scene_duration:.2f} seconds")
-
-                # --- Create image clip ---
-                # Set image duration to match audio duration
-
-                image = Image.open(BytesIO(image_base64))
-                # Convert to RGB if necessary (MoviePy works best with RGB)
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                # Convert PIL image to numpy array
-                image_array = np.array(image)
-                img_clip = ImageClip(image_array).with_duration(scene_duration)
-
-                # --- Set audio for the image clip ---
-                video_clip = img_clip.with_audio(audio_clip)
-
-                # Add the completed scene clip to our list
-                scene_clips.append(video_clip)
-                print(f"  Successfully created video clip for scene {scene_num}.")
-
-            except Exception as e:
-                print(f"  Error processing scene {scene_num}: {e}")
-                # Ensure clips are closed if an error occurs mid-processing
-                if 'audio_clip' in locals() and hasattr(audio_clip, 'close'):
-                    audio_clip.close()
-                if 'img_clip' in locals() and hasattr(img_clip, 'close'):
-                    img_clip.close()
-                if 'video_clip' in locals() and hasattr(video_clip, 'close'):
-                    video_clip.close()
-
-
-    else:
-        print("Error: 'scenes' key not found or is not a list in final_state.")
-
-    # --- Concatenate all scene clips ---
-    if scene_clips:
-        print(f"\nConcatenating {len(scene_clips)} scene clips...")
-        # Force flush logs to ensure they're sent immediately
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
-        # Yield control to allow event loop to process log streaming
-        try:
-            print("Concatenating video clips...")
-            # Force flush logs to ensure they're sent immediately
-            sys.stdout.flush()
-            sys.stderr.flush()
-            # Yield control to allow event loop to process log streaming
-            final_clip = concatenate_videoclips(scene_clips, method="compose")
-            # --- Cleanup: Close any remaining clips in the list ---
-            print("Cleaning up...")
-            # Force flush logs to ensure they're sent immediately
-            sys.stdout.flush()
-            sys.stderr.flush()
-            # Yield control to allow event loop to process log streaming
-            for clip in scene_clips:
-                if hasattr(clip, 'close'):
-                    clip.close()
-            print("Video creation process finished.")
-            # Force flush logs to ensure they're sent immediately
-            sys.stdout.flush()
-            sys.stderr.flush()
-            # Yield control to allow event loop to process log streaming
-            return final_clip
-            
-        except Exception as e:
-            print(f"Error during concatenation: {e}")
-            # Close any remaining clips on error
-            for clip in scene_clips:
-                if hasattr(clip, 'close'):
-                    clip.close()
-            raise
-    else:
-        print("No valid scene clips were created. Final video cannot be generated.")
-        # Return a simple black clip as fallback
-        from moviepy import ColorClip
-        return ColorClip(size=(640, 480), color=(0, 0, 0), duration=1)
-
-    
-    
-
-    
-
-    
\ No newline at end of file
+    logger.info("Starting video creation process...")
+    scenes = _scene_list(final_state)
+
+    async def collect():
+        return b"".join([chunk async for chunk in stream_encode_video(scenes)])
+
+    return asyncio.run(collect())
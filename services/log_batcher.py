@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+# Deliver buffered log messages once this many are waiting...
+MAX_BATCH_MESSAGES = 32
+# ...or once the oldest has waited this many seconds
+MAX_BATCH_DELAY = 0.05
+
+class LogBatcher:
+    """
+    Buffers log messages for one process and publishes them to its ProcessLog in batches.
+
+    Messages are delivered when MAX_BATCH_MESSAGES have accumulated or the
+    oldest one has waited MAX_BATCH_DELAY seconds, rather than one at a time.
+    """
+
+    def __init__(self, process_id=None, log_storage=None,
+                 max_messages=MAX_BATCH_MESSAGES, max_delay=MAX_BATCH_DELAY):
+        self.process_id = process_id
+        self.log_storage = log_storage
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self._pending = []
+        self._first_at = None
+        self._timer = None
+
+    def append(self, message):
+        """Buffer a message, delivering the batch if it is full"""
+        self._pending.append(message)
+        if len(self._pending) == 1:
+            self._first_at = time.monotonic()
+            self._schedule_flush()
+        if self._timer is None:
+            # No event loop to time the batch, so the deadline is checked as messages arrive
+            self.maybe_flush()
+        elif len(self._pending) >= self.max_messages:
+            self.flush()
+
+    def maybe_flush(self):
+        """Deliver buffered messages if the batch is full or the oldest one is due"""
+        if self._pending and (
+            len(self._pending) >= self.max_messages
+            or time.monotonic() - self._first_at >= self.max_delay
+        ):
+            self.flush()
+
+    def flush(self):
+        """Deliver all buffered messages now"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if self.process_id and self.log_storage and self.process_id in self.log_storage:
+            process_log = self.log_storage[self.process_id]
+            for message in pending:
+                process_log.publish(message)
+
+    def _schedule_flush(self):
+        """Make sure a batch started while the caller sits in a long await still goes out on time"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Synchronous callers: append() checks the deadline itself
+            return
+        self._timer = loop.call_later(self.max_delay, self.flush)
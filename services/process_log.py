@@ -0,0 +1,61 @@
+import asyncio
+from collections import deque
+
+# Messages kept per process for streams that connect, or reconnect, after they were published
+LOG_REPLAY_SIZE = 1000
+
+class ProcessLog:
+    """
+    The log of one story run, fanned out to every stream following it.
+
+    Published messages are numbered and kept in a bounded replay buffer, and each
+    subscriber gets its own queue, so a second tab or an EventSource reconnect
+    receives every message instead of splitting them with the first stream.
+    """
+
+    def __init__(self, replay_size=LOG_REPLAY_SIZE):
+        self._history = deque(maxlen=replay_size)
+        self._next_id = 0
+        self._subscribers = set()
+        self.finished = False
+
+    def publish(self, message):
+        """Record a message and hand it to every subscriber"""
+        entry = (self._next_id, message)
+        self._next_id += 1
+        self._history.append(entry)
+        for subscriber in self._subscribers:
+            subscriber.put_nowait(entry)
+
+    def finish(self):
+        """Mark the run as done; subscribers stop once they have received everything before this"""
+        self.finished = True
+        for subscriber in self._subscribers:
+            subscriber.put_nowait(None)
+
+    async def subscribe(self, after=-1):
+        """
+        Follow the log from just after message `after` until the run is finished.
+
+        Args:
+            after (int): ID of the last message the caller already has, e.g. from Last-Event-ID
+
+        Yields:
+            (id, message) pairs: the buffered ones first, then new ones as they are published
+        """
+        queue = asyncio.Queue()
+        # Replay and register without awaiting in between, so no message is missed or sent twice
+        for entry in self._history:
+            if entry[0] > after:
+                queue.put_nowait(entry)
+        if self.finished:
+            queue.put_nowait(None)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                entry = await queue.get()
+                if entry is None:
+                    return
+                yield entry
+        finally:
+            self._subscribers.discard(queue)
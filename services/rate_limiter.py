@@ -0,0 +1,51 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+class SlidingWindowLimiter:
+    """
+    Keeps requests to a rate-limited API within `max_requests` per `period` seconds.
+
+    Remembers when the last `max_requests` requests went out; a new request
+    waits only while the oldest of them is less than `period` seconds old.
+    Bursts go out at once while budget remains, and no window of `period`
+    seconds ever sees more than `max_requests`. One limiter covers one quota
+    (an API key's text or image model) and can be shared by every story using
+    it. When the API itself reports that quota as exhausted, pause() holds the
+    limiter's requests until it asks us to retry.
+    """
+
+    def __init__(self, max_requests, period=60.0):
+        self.max_requests = max_requests
+        self.period = period
+        self._sent = deque()
+        self._paused_until = 0.0
+        # Stories can run on different event loops (see create_finalstate), so guard with a thread lock
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Record a request if the window has room; otherwise return the seconds until it will"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            while self._sent and now - self._sent[0] >= self.period:
+                self._sent.popleft()
+            if len(self._sent) < self.max_requests:
+                self._sent.append(now)
+                return 0
+            return self.period - (now - self._sent[0])
+
+    async def acquire(self):
+        """Wait until a request may be sent"""
+        while True:
+            wait = self._reserve()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold all requests for `seconds`, e.g. the retry delay the API sent with a 429"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
@@ -1,12 +1,18 @@
+import base64
+import hashlib
+import itertools
 import operator
 import os
+import logging
 from typing import Optional
-import time # Added for delays gemini-2.0-flash has rate limits of 10 per min
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 
 # Langchain/LangGraph specific imports
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
+from langchain_core.output_parsers import JsonOutputParser
 from langchain_google_genai import ChatGoogleGenerativeAI # For text generation
 from langchain_community.chat_models import ChatOpenAI
 from langgraph.graph import StateGraph, END
@@ -25,6 +31,15 @@ except ImportError:
     genai = None
     types = None
 
+# HTTP/2 for the GenAI client needs the h2 package (httpx[http2])
+try:
+    import h2  # noqa: F401
+    import httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+    httpx = None
+
 # FastRTC for TTS
 try:
     from fastrtc import get_tts_model
@@ -34,327 +49,446 @@ except ImportError:
     get_tts_model = None
 
 from models.story import StoryAnalysisState
-from config.settings import Settings
+from config.settings import get_settings
+from services.rate_limiter import SlidingWindowLimiter
 
-settings = Settings()
+settings = get_settings()
+
+logger = logging.getLogger("story_viz.story_processor")
 
 # In-memory storage for video data (in a production app, you might use Redis or similar)
 # Each entry contains: {'data': bytes, 'timestamp': datetime}
 video_storage = {}
 
-# Global variables for models
-llm = None
-genai_client = None
+# Scenes sent to the text model per image-prompt request
+IMAGE_PROMPT_BATCH_SIZE = 6
+
+# Per-story limits on concurrent text-model and image requests
+LLM_REQUEST_CONCURRENCY = 4
+IMAGE_REQUEST_CONCURRENCY = 4
+
+# Speech synthesis is CPU-bound native code that releases the GIL, so scenes are synthesized on
+# these threads. The pool is shared by all stories so concurrent requests can't oversubscribe the CPU
+TTS_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='tts')
+
+# Generated character descriptions by (story digest, character name), so re-running a story reuses them.
+# The oldest entries are dropped once it holds DESCRIPTION_CACHE_SIZE
+DESCRIPTION_CACHE_SIZE = 512
+_description_cache = {}
+
+# A request the API rejects with 429 is retried this many times, after the delay the API asks for
+# (or DEFAULT_RETRY_AFTER seconds when the error carries none)
+RATE_LIMIT_RETRIES = 2
+DEFAULT_RETRY_AFTER = 10.0
+
+# Connections each GenAI client may hold open; with HTTP/2 concurrent image requests share them as streams
+GENAI_MAX_CONNECTIONS = 16
+
+# Clients and rate limiters per Google API key, most recently used last. Quotas are counted per key, so
+# every key gets its own text and image limiters, shared by all stories using that key. Each run gets its
+# entry through the graph state, so a story keeps its own key's clients even if another request arrives
+# with a different key. The least recently used key is dropped once it holds CLIENT_CACHE_SIZE.
+# Each entry is {'clients': mapping merged into the graph state, 'http_client': the httpx client we
+# handed to google-genai (which never closes it), 'runs': runs currently using the entry}
+CLIENT_CACHE_SIZE = 32
+_client_cache = {}
+# Entries dropped from _client_cache (or never cached) whose HTTP client is closed once no run uses them
+_retired_clients = []
+_client_cache_lock = threading.Lock()
+# Background closes started by release_models()
+_closing_tasks = set()
+# The TTS model doesn't depend on the API key, so one is shared by every run
 tts_model = None
 
-# Process ID for logging
-current_process_id = None
-log_storage = None  # Will be set by set_log_storage function
-
-def set_log_storage(storage):
-    """Set the log storage reference"""
-    global log_storage
-    log_storage = storage
-
-def set_process_id(process_id):
-    """Set the current process ID for logging"""
-    global current_process_id
-    current_process_id = process_id
-
-def log_message(message):
-    """Log a message to the current process log"""
-    if current_process_id and log_storage and current_process_id in log_storage:
-        log_storage[current_process_id].append(message)
-        print(f"[LOG] {message}")  # Also print to console for debugging
-        # Force flush to ensure immediate availability
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
-    else:
-        print(f"[LOG FALLBACK] {message}")  # Fallback to console printing
-        # Force flush to ensure immediate availability
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
+class OrjsonOutputParser(JsonOutputParser):
+    """JsonOutputParser that parses complete replies with orjson, falling back to the stock parser"""
+
+    def parse_result(self, result, *, partial=False):
+        if not partial:
+            text = result[0].text.strip()
+            # Models often wrap the JSON in a ```json fence
+            if text.startswith("```"):
+                text = text.partition("\n")[2].rsplit("```", 1)[0]
+            try:
+                return orjson.loads(text)
+            except orjson.JSONDecodeError:
+                pass
+        return super().parse_result(result, partial=partial)
+
+def _retry_after(error):
+    """
+    Get the retry delay from a rate-limit error raised by either Google client.
+
+    Args:
+        error (Exception): The exception raised by the request
+
+    Returns:
+        float or None: Seconds to wait before retrying, or None if `error` is not a 429
+    """
+    # LangChain wraps the api_core error, so look through the exception's causes too
+    while error is not None and getattr(error, 'code', None) != 429:
+        error = error.__cause__
+    if error is None:
+        return None
+    details = getattr(error, 'details', None)
+    # google-genai keeps the JSON error body; api_core gives a list of RetryInfo-style messages
+    if isinstance(details, dict):
+        details = (details.get('error') or {}).get('details') or []
+    for detail in details or []:
+        if isinstance(detail, dict) and detail.get('retryDelay'):
+            return float(detail['retryDelay'].rstrip('s'))
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return DEFAULT_RETRY_AFTER
+
+async def call_rate_limited(rate_limiter, request):
+    """
+    Send a request within `rate_limiter`'s budget, retrying it if the API answers 429.
+
+    On a 429 the limiter is paused for the delay the API asked for, so the other stories
+    using the same API key hold off as well instead of piling onto its quota. Limiters
+    are per key, so stories on other keys are not held up.
+
+    Args:
+        rate_limiter (SlidingWindowLimiter): The limiter of the API key and model being called
+        request (callable): Returns a new awaitable that sends the request
+
+    Returns:
+        The awaited result of `request()`
+    """
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        await rate_limiter.acquire()
+        try:
+            return await request()
+        except Exception as e:
+            delay = _retry_after(e)
+            if delay is None or attempt == RATE_LIMIT_RETRIES:
+                raise
+            logger.warning("Rate limited by the API; retrying in %.1fs", delay)
+            rate_limiter.pause(delay)
+
+def log_message(state, message):
+    """
+    Log a message to the ProcessLog of the process that owns `state`.
 
-def initialize_models(api_key: Optional[str] = None):
+    Args:
+        state: Graph state (or any mapping) carrying a 'log_batcher'; may be None
+        message (str): The message to log
+    """
+    logger.info("%s", message)  # Also log to console for debugging
+    log_batcher = state.get("log_batcher") if state else None
+    if log_batcher is not None:
+        log_batcher.append(message)
+
+def initialize_models(api_key: Optional[str] = None, log_context: Optional[dict] = None):
     """
     Initialize the models with provided API configuration
+
+    Args:
+        api_key (str, optional): Google API key; falls back to settings
+        log_context (dict, optional): Mapping with a 'log_batcher' to log progress to
+
+    Returns:
+        dict: The key's 'genai_client' and 'llm' (either may be None if it could not be created)
+        and its 'llm_rate_limiter' and 'image_rate_limiter', ready to merge into the graph state.
+        Hand it to release_models() once the run is done
     """
-    global llm, genai_client, tts_model
+    global tts_model
     
     # Use provided API key or fallback to settings
     google_api_key = api_key or settings.GOOGLE_API_KEY
     image_model = "gemini-2.0-flash-exp-image-generation"
     openrouter_api_key = settings.OPENROUTER_API_KEY
-    # Initialize Google GenAI for image generation
-    if google_api_key and GOOGLE_GENAI_AVAILABLE:
-        try:
-            os.environ["GOOGLE_API_KEY"] = google_api_key
-            genai_client = genai.Client()
-            log_message(f"Google GenAI Image Generation client initialized with model: {image_model}")
-        except Exception as e:
-            log_message(f"Error initializing Google GenAI Image Generation client: {e}")
-            genai_client = None
+    # Clients are kept per API key, so requests that alternate keys don't rebuild them
+    with _client_cache_lock:
+        entry = _client_cache.pop(google_api_key, None)
+        if entry is not None:
+            # Re-inserting moves the key to the most recently used end
+            _client_cache[google_api_key] = entry
+            entry["runs"] += 1
+    if entry is not None:
+        log_message(log_context, "Reusing Google GenAI clients for this API key")
     else:
-        genai_client = None
-        if not google_api_key:
-            log_message("⚠️ Google API key not provided. Using mock image generation.")
-    
-    # Initialize LLM model
-    if google_api_key and GOOGLE_GENAI_AVAILABLE:
-        try:
-            os.environ["GOOGLE_API_KEY"] = google_api_key
-            llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.7)
-            # llm = ChatOpenAI(
+        # Initialize Google GenAI for image generation
+        http_client = None
+        if google_api_key and GOOGLE_GENAI_AVAILABLE:
+            try:
+                # The key goes to the client itself rather than os.environ, which every request shares
+                http_options = None
+                if HTTP2_AVAILABLE:
+                    # Image requests from every story multiplex over the same few connections. The client
+                    # is handed over ready-made: async_client_args would go to aiohttp instead whenever it
+                    # is installed, and aiohttp accepts neither option
+                    http_client = httpx.AsyncClient(
+                        http2=True,
+                        limits=httpx.Limits(max_connections=GENAI_MAX_CONNECTIONS),
+                    )
+                    http_options = types.HttpOptions(httpx_async_client=http_client)
+                genai_client = genai.Client(api_key=google_api_key, http_options=http_options)
+                log_message(log_context, f"Google GenAI Image Generation client initialized with model: {image_model}")
+            except Exception as e:
+                log_message(log_context, f"Error initializing Google GenAI Image Generation client: {e}")
+                genai_client = None
+        else:
+            genai_client = None
+            if not google_api_key:
+                log_message(log_context, "⚠️ Google API key not provided. Using mock image generation.")
 
-            #                 openai_api_key=openrouter_api_key,
+        # Initialize LLM model
+        if google_api_key and GOOGLE_GENAI_AVAILABLE:
+            try:
+                llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.7, google_api_key=google_api_key)
+                # llm = ChatOpenAI(
 
-            #                 openai_api_base="https://openrouter.ai/api/v1",
+                #                 openai_api_key=openrouter_api_key,
 
-            #                 model_name="google/gemini-2.5-pro-exp-03-25"
-            #                 )
-            
-            log_message(f"Google GenAI LLM initialized with model: gemini-2.0-flash")
-        except Exception as e:
-            log_message(f"Error initializing Google GenAI LLM: {e}")
+                #                 openai_api_base="https://openrouter.ai/api/v1",
+
+                #                 model_name="google/gemini-2.5-pro-exp-03-25"
+                #                 )
+
+                log_message(log_context, f"Google GenAI LLM initialized with model: gemini-2.0-flash")
+            except Exception as e:
+                log_message(log_context, f"Error initializing Google GenAI LLM: {e}")
+                llm = None
+        else:
             llm = None
-    else:
-        llm = None
-        if not google_api_key:
-            log_message("⚠️ Google API key not provided.")
-      
+            if not google_api_key:
+                log_message(log_context, "⚠️ Google API key not provided.")
+
+        entry = {
+            "clients": {
+                "genai_client": genai_client,
+                "llm": llm,
+                # The text and image models have separate quotas
+                "llm_rate_limiter": SlidingWindowLimiter(settings.GENAI_REQUESTS_PER_MINUTE),
+                "image_rate_limiter": SlidingWindowLimiter(settings.GENAI_REQUESTS_PER_MINUTE),
+            },
+            "http_client": http_client,
+            "runs": 1,
+        }
+        with _client_cache_lock:
+            if genai_client is not None and llm is not None:
+                _client_cache[google_api_key] = entry
+                if len(_client_cache) > CLIENT_CACHE_SIZE:
+                    _retired_clients.append(_client_cache.pop(next(iter(_client_cache))))
+            else:
+                # Not worth caching, but its HTTP client still has to be closed after this run
+                _retired_clients.append(entry)
 
-    # Initialize FastRTC TTS model
+    # Initialize FastRTC TTS model (it doesn't depend on the API key, so load it only once)
     if FASTRTC_AVAILABLE:
-        try:
-            tts_model = get_tts_model()
-            log_message("FastRTC TTS model initialized")
-        except Exception as e:
-            log_message(f"Error initializing FastRTC TTS model: {e}")
-            tts_model = None
+        if tts_model is None:
+            try:
+                tts_model = get_tts_model()
+                log_message(log_context, "FastRTC TTS model initialized")
+            except Exception as e:
+                log_message(log_context, f"Error initializing FastRTC TTS model: {e}")
+                tts_model = None
     else:
         tts_model = None
-        log_message("⚠️ FastRTC library not available.")
+        log_message(log_context, "⚠️ FastRTC library not available.")
 
-# --- 2. Define Nodes (Functions) ---
+    return entry["clients"]
 
-def read_story(state: StoryAnalysisState) -> StoryAnalysisState:
-    """
-    Node to load the story text into the state.
-    """
-    log = state.get("processing_log", [])
-    log.append("Reading story...")
-    log_message("--- Reading Story ---")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
-    return {"processing_log": log}
+async def _close_http_client(entry):
+    """Close the httpx client of a client cache entry, if it has one"""
+    if entry["http_client"] is not None:
+        try:
+            await entry["http_client"].aclose()
+        except Exception as e:
+            logger.warning("Error closing GenAI HTTP client: %s", e)
 
-async def analyze_characters(state: StoryAnalysisState) -> StoryAnalysisState:
-    """
-    Node to identify characters and their initial descriptions using Gemini (via Langchain).
+async def _close_http_clients(entries):
+    """Close the httpx clients of several client cache entries"""
+    for entry in entries:
+        await _close_http_client(entry)
+
+def release_models(clients):
     """
-    log = state.get("processing_log", [])
-    log.append("Analyzing characters using Gemini...")
-    log_message("--- Analyzing Characters (using Gemini) ---")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
-    story = state["story_text"]
-    characters_found = {}
+    Mark a run as done with the clients initialize_models() gave it.
 
+    Closes the HTTP clients of dropped cache entries that no run uses any more: in
+    the background on the running event loop, or right away for synchronous callers.
 
-    prompt_template = ChatPromptTemplate.from_messages([
-        ("system", """You are an expert literary analyst. Your task is to read the provided story text and identify all named characters.
+    Args:
+        clients (dict): The mapping returned by initialize_models()
+    """
+    with _client_cache_lock:
+        for entry in itertools.chain(_client_cache.values(), _retired_clients):
+            if entry["clients"] is clients:
+                entry["runs"] -= 1
+                break
+        idle = [entry for entry in _retired_clients if entry["runs"] <= 0]
+        _retired_clients[:] = [entry for entry in _retired_clients if entry["runs"] > 0]
+    if not idle:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(_close_http_clients(idle))
+        return
+    # Hold a reference until the task is done, or it could be garbage collected mid-close
+    task = loop.create_task(_close_http_clients(idle))
+    _closing_tasks.add(task)
+    task.add_done_callback(_closing_tasks.discard)
+
+async def close_models():
+    """Close the HTTP clients of every cached and dropped entry, e.g. at shutdown"""
+    with _client_cache_lock:
+        entries = list(_client_cache.values()) + _retired_clients
+        _client_cache.clear()
+        _retired_clients.clear()
+    await _close_http_clients(entries)
+    # Let closes started by release_models() finish too
+    if _closing_tasks:
+        await asyncio.gather(*_closing_tasks, return_exceptions=True)
+
+# --- Prompts ---
+# Built once at import; nodes only pipe them into their run's llm
+
+# The three analyses share one request so the story is only sent (and read by the model) once
+ANALYZE_STORY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are an expert literary analyst, screenwriter and art director. Read the provided story text and complete the three tasks below.
+Output the results as a single JSON object with the keys "characters", "scenes" and "overall_style".
+
+TASK 1 - "characters": Identify all named characters.
 For each character, extract any description of their appearance, or notable features mentioned directly in the text.
-Output the results as a JSON object where keys are the character names and values are dictionaries containing a single key "description" with the extracted description as a string.
+Output a JSON object where keys are the character names and values are dictionaries containing a single key "description" with the extracted description as a string.
 If no description is found for a character, set the value of "description" to null or an empty string.
 
+TASK 2 - "scenes": Divide the story into logical scenes based on changes in location, time, or main character focus.
+For each scene you identify, provide the following details:
+1.  `scene_number`: An integer starting from 1.
+2.  `scene_text`: A full text from the scene directly from the story.
+3.  `summary`: A brief 1-2 sentence summary of the main action or content of the scene.
+4.  `setting`: A short description of the scene's location and environment (e.g., 'sunny river bank', 'dark forest path', 'inside a rabbit hole').
+5.  `characters_present`: A list of names of the characters who are actively present in the scene. Use the character names from TASK 1. If other characters seem present, include their names too.
+6.  `tone`: A single word or short phrase describing the overall mood or tone of the scene (e.g., 'calm', 'curious', 'frantic', 'mysterious', 'tense', 'confusing').
+Output a JSON list, where each element is an object representing a scene with the keys 'scene_number', 'scene_text', 'summary', 'setting', 'characters_present', and 'tone'.
+
+TASK 3 - "overall_style": Based on the overall tone, genre, setting, and content of the story, suggest a concise visual style descriptor suitable for guiding an image generation model.
+Examples: 'children's book illustration', 'dark fantasy oil painting', 'realistic sci-fi render', 'vintage cartoon style', 'photorealistic, cinematic lighting'.
+Output the descriptor as a string.
+
 Example JSON output format:
 {{
-  "Character Name 1": {{"description": "Description found in text."}},
-  "Character Name 2": {{"description": null}}
+  "characters": {{
+    "Character A": {{"description": "Description found in text."}},
+    "Character B": {{"description": null}}
+  }},
+  "scenes": [
+    {{
+      "scene_number": 1,
+      "scene_text": "A wakes up to a new day in his tiny and messy bedroom, but A feels refresh, looking forward to go on this adventures.",
+      "summary": "Character A wakes up and prepares for their journey.",
+      "setting": "Small, cluttered bedroom",
+      "characters_present": ["Character A"],
+      "tone": "calm"
+    }},
+    {{
+      "scene_number": 2,
+      "scene_text": "A was wandering through the forest, the sun shinning through the leaves. A enjoyed his time in the wood when he ran into B, B is supposed to be sick.",
+      "summary": "Character A meets Character B while walking through the forest.",
+      "setting": "Sun-dappled forest path",
+      "characters_present": ["Character A", "Character B"],
+      "tone": "curious"
+    }}
+  ],
+  "overall_style": "children's book illustration"
 }}
 """),
-        ("human", "Please analyze the following story text:\n\n{story_text}")
-    ])
-    parser = JsonOutputParser()
-    chain = prompt_template | llm | parser
+    ("human", "Please analyze the following story text:\n\n{story_text}")
+])
 
-    try:
-        response = await chain.ainvoke({"story_text": story})
-        # Force flush logs to ensure they're sent immediately
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
-        characters_found = response
-        # Ensure description is always a string (replace null with empty string if needed)
-        for char, details in characters_found.items():
-            if details is not None and details.get("description") is None:
-                 characters_found[char]["description"] = ""
-            # Handle cases where the character value itself might be None from JSON
-            elif details is None:
-                 characters_found[char] = {"description": ""}
-        log.append(f"Successfully analyzed characters. Found: {list(characters_found.keys())}")
-        log_message(f"Found characters: {characters_found}")
-    except Exception as e:
-        log.append(f"Error analyzing characters: {e}")
-        log_message(f"Error during character analysis: {e}")
+# All missing characters share one request, so the story context is only sent once
+CHARACTER_DESCRIPTIONS_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are a creative character designer. Based on each character's name and the provided story context, generate a brief, plausible physical description (appearance, clothing, general impression) for each character.
+Focus on visual details suitable for image generation later.
+Output ONLY a JSON object where keys are the character names exactly as given and values are the generated descriptions as plain strings."""),
+    ("human", "Generate a description for each of these characters: {character_names}\n\nBased on this story context:\n\n{story_context}")
+])
+
+SCENE_IMAGE_PROMPTS_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are an expert prompt engineer for text-to-image models.
+Based on the provided scene details, create a concise yet descriptive prompt suitable for generating an image for each scene.
+Each prompt should capture the essence of its scene: the environment, characters (incorporating their descriptions), actions, and mood/tone.
+Focus on visual elements.
+Output ONLY a JSON list of strings containing exactly one prompt per scene, in the order the scenes are given.
+"""),
+    ("human", """Generate an image prompt for each of the following {scene_count} scenes:
 
-    return {"characters": characters_found, "processing_log": log}
+{scene_details}""")
+])
 
+JSON_PARSER = OrjsonOutputParser()
 
-async def generate_missing_descriptions(state: StoryAnalysisState) -> StoryAnalysisState:
+# --- 2. Define Nodes (Functions) ---
+
+def read_story(state: StoryAnalysisState) -> StoryAnalysisState:
     """
-    Node to generate descriptions for characters identified without one using Gemini (via Langchain).
+    Node to load the story text into the state.
     """
     log = state.get("processing_log", [])
-    log.append("Checking for and generating missing descriptions using Gemini...")
-    log_message("--- Generating Missing Descriptions (using Gemini) ---")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
-    characters = state.get("characters", {})
-    story = state["story_text"]
-    updated_characters = characters.copy()
-
-
-    prompt_template = ChatPromptTemplate.from_messages([
-        ("system", """You are a creative character designer. Based on the character's name and the provided story context, generate a brief, plausible physical description (appearance, clothing, general impression) for the character.
-Focus on visual details suitable for image generation later.
-Output ONLY the generated description as a plain string."""),
-        ("human", "Generate a description for the character '{character_name}' based on this story context:\n\n{story_context}")
-    ])
-    parser = StrOutputParser()
-    chain = prompt_template | llm | parser
-
-    characters_to_generate = []
-    if isinstance(characters, dict):
-        for name, details in characters.items():
-            # Check if details is a dict and if description is missing/empty
-            if isinstance(details, dict) and not details.get("description", "").strip():
-                characters_to_generate.append(name)
-            # Handle cases where the character entry might not be a dict (e.g., due to parsing error)
-            elif not isinstance(details, dict):
-                 log.append(f"Skipping description generation for '{name}' due to unexpected format: {details}")
-                 log_message(f"Warning: Skipping description generation for '{name}' due to unexpected format.")
-                 # Ensure the entry is a dict for consistency, even if description remains missing
-                 updated_characters[name] = {"description": ""}
-
-
-    if not characters_to_generate:
-        log.append("No missing descriptions to generate.")
-        log_message("No missing descriptions to generate.")
-        # Ensure the returned state always includes the characters dict
-        return {"characters": updated_characters, "processing_log": log}
-
-    log_message(f"Attempting to generate descriptions for: {', '.join(characters_to_generate)}")
-    for name in characters_to_generate:
-        await asyncio.sleep(8) #Gemini-2.0-flash has rate limit of 10 per minute
-        # Force flush logs to ensure they're sent immediately
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
-        try:
-            # Invoke the chain
-            generated_desc = await chain.ainvoke({
-                "character_name": name,
-                "story_context": story # Provide the full story as context
-            })
-            # Force flush logs to ensure they're sent immediately
-            import sys
-            sys.stdout.flush()
-            sys.stderr.flush()
-            # Ensure the character exists in updated_characters before assigning
-            if name not in updated_characters:
-                 updated_characters[name] = {} # Initialize if somehow missing
-            updated_characters[name]["description"] = generated_desc.strip()
-            log.append(f"Successfully generated description for {name}.")
-            log_message(f"Generated description for {name}: {generated_desc.strip()}")
-            # Force flush logs to ensure they're sent immediately
-            sys.stdout.flush()
-            sys.stderr.flush()
-        except Exception as e:
-            log.append(f"Error generating description for {name}: {e}")
-            log_message(f"Error generating description for {name}: {e}")
-            # Optionally set a default error description
-            if name not in updated_characters:
-                 updated_characters[name] = {}
-            updated_characters[name]["description"] = "Error generating description."
-
-    return {"characters": updated_characters, "processing_log": log}
-
+    log.append("Reading story...")
+    log_message(state, "--- Reading Story ---")
+    return {"processing_log": log}
 
-async def analyze_scenes(state: StoryAnalysisState) -> StoryAnalysisState:
+async def analyze_story(state: StoryAnalysisState) -> StoryAnalysisState:
     """
-    Node to break the story into scenes and extract details for each using Gemini (via Langchain).
+    Node to identify the characters, break the story into scenes and determine an overall
+    visual style using a single Gemini (via Langchain) request over the story text.
     """
     log = state.get("processing_log", [])
-    log.append("Analyzing scenes using Gemini...")
-    log_message("--- Analyzing Scenes (using Gemini) ---")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
+    log.append("Analyzing characters, scenes and visual style using Gemini...")
+    log_message(state, "--- Analyzing Story (using Gemini) ---")
     story = state["story_text"]
-    character_names = list(state.get("characters", {}).keys())
+    characters_found = {}
     scenes_found = []
+    suggested_style = None # Initialize
 
-    prompt_template = ChatPromptTemplate.from_messages([
-        ("system", """You are a skilled screenwriter and story analyst. Your task is to read the provided story text and divide it into logical scenes based on changes in location, time, or main character focus.
-
-For each scene you identify, provide the following details:
-1.  `scene_number`: An integer starting from 1.
-2.  `scene_text`: A full text from the scene directly from the story.
-3.  `summary`: A brief 1-2 sentence summary of the main action or content of the scene.
-4.  `setting`: A short description of the scene's location and environment (e.g., 'sunny river bank', 'dark forest path', 'inside a rabbit hole').
-5.  `characters_present`: A list of names of the characters who are actively present in the scene. Use the provided list of known character names: {character_list}. If other characters seem present, include their names too.
-6.  `tone`: A single word or short phrase describing the overall mood or tone of the scene (e.g., 'calm', 'curious', 'frantic', 'mysterious', 'tense', 'confusing').
+    chain = ANALYZE_STORY_PROMPT | state["llm"] | JSON_PARSER
+    llm_rate_limiter = state["llm_rate_limiter"]
 
-Output the results as a JSON list, where each element in the list is an object representing a scene with the keys 'scene_number', 'scene_text', 'summary', 'setting', 'characters_present', and 'tone'.
+    try:
+        response = await call_rate_limited(llm_rate_limiter, lambda: chain.ainvoke({"story_text": story}))
+        if not isinstance(response, dict):
+            raise ValueError(f"expected a JSON object, got {response!r}")
+    except Exception as e:
+        log.append(f"Error analyzing story: {e}")
+        log_message(state, f"Error during story analysis: {e}")
+        response = {}
 
-Example JSON output format:
-[
-  {{
-    "scene_number": 1,
-    "scene_text": "A wakes up to a new day in his tiny and messy bedroom, but A feels refresh, looking forward to go on this adventures.",
-    "summary": "Character A wakes up and prepares for their journey.",
-    "setting": "Small, cluttered bedroom",
-    "characters_present": ["Character A"],
-    "tone": "calm"
-  }},
-  {{
-    "scene_number": 2,
-    "scene_text": "A was wandering through the forest, the sun shinning through the leaves. A enjoyed his time in the wood when he ran into B, B is supposed to be sick.",
-    "summary": "Character A meets Character B while walking through the forest.",
-    "setting": "Sun-dappled forest path",
-    "characters_present": ["Character A", "Character B"],
-    "tone": "curious"
-  }}
-]
-"""),
-        ("human", "Please analyze the following story text and identify the scenes:\n\n{story_text}\n\nKnown character names: {character_list_str}")
-    ])
-    parser = JsonOutputParser()
-    chain = prompt_template | llm | parser
+    # Each part of the reply is checked on its own, so a malformed one doesn't cost the others
+    try:
+        characters = response.get("characters") or {}
+        if not isinstance(characters, dict):
+            raise ValueError(f"expected an object of characters, got {characters!r}")
+        # Ensure description is always a string (replace null with empty string if needed)
+        for char, details in characters.items():
+            # Handle cases where the character value itself is not an object (null, a bare string, ...)
+            if not isinstance(details, dict):
+                details = {"description": str(details or "")}
+            elif details.get("description") is None:
+                details["description"] = ""
+            characters_found[char] = details
+        log.append(f"Successfully analyzed characters. Found: {list(characters_found.keys())}")
+        log_message(state, f"Found characters: {characters_found}")
+    except Exception as e:
+        log.append(f"Error analyzing characters: {e}")
+        log_message(state, f"Error during character analysis: {e}")
+        characters_found = {}
 
     try:
-        response = await chain.ainvoke({
-            "story_text": story,
-            "character_list": character_names,
-            "character_list_str": ", ".join(character_names)
-        })
-        # Force flush logs to ensure they're sent immediately
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
-        # Initialize added fields
-        scenes_found = []
-        for scene_data in response:
+        scenes = response.get("scenes") or []
+        if not isinstance(scenes, list):
+            raise ValueError(f"expected a list of scenes, got {scenes!r}")
+        for scene_data in scenes:
+             if not isinstance(scene_data, dict):
+                 log.append(f"Skipping malformed scene: {scene_data!r}")
+                 log_message(state, f"Warning: Skipping malformed scene: {scene_data!r}")
+                 continue
              # Ensure basic structure even if LLM hallucinates extra fields
              validated_scene_data = {
                  'scene_number': scene_data.get('scene_number'),
@@ -364,75 +498,117 @@ Example JSON output format:
                  'characters_present': scene_data.get('characters_present', []),
                  'tone': scene_data.get('tone'),
                  'image_prompt': None,
-                 'image_base64': None,
+                 'image_bytes': None,
                  'audio_array': None
              }
              scenes_found.append(validated_scene_data)
-
-
         log.append(f"Successfully analyzed scenes. Found {len(scenes_found)} scenes.")
-        log_message(f"Found {len(scenes_found)} scenes.")
-
+        log_message(state, f"Found {len(scenes_found)} scenes.")
     except Exception as e:
         log.append(f"Error analyzing scenes: {e}")
-        log_message(f"Error during scene analysis: {e}")
-        scenes_found = [] # Ensure it's an empty list on error
-
-    return {"scenes": scenes_found, "processing_log": log}
-
-
-async def determine_overall_style(state: StoryAnalysisState) -> StoryAnalysisState:
-    """
-    Node to determine an overall visual style based on the story text using Gemini for consistent style for image generation.
-    """
-    log = state.get("processing_log", [])
-    log.append("Determining overall visual style using Gemini...")
-    log_message("--- Determining Overall Visual Style (using Gemini) ---")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
-    story = state["story_text"]
-    suggested_style = None # Initialize
-
-    # Prompt to suggest a style
-    prompt_template = ChatPromptTemplate.from_messages([
-        ("system", """You are an expert art director. Based on the overall tone, genre, setting, and content of the following story, suggest a concise visual style descriptor suitable for guiding an image generation model.
-Examples: 'children's book illustration', 'dark fantasy oil painting', 'realistic sci-fi render', 'vintage cartoon style', 'photorealistic, cinematic lighting'.
-Output ONLY the suggested style descriptor string, prefixed with a space (e.g., ' children's book illustration')."""),
-        ("human", "Determine a visual style for this story:\n\n{story_text}")
-    ])
-
-    parser = StrOutputParser()
-    chain = prompt_template | llm | parser
+        log_message(state, f"Error during scene analysis: {e}")
 
     try:
-        # Invoke the chain with the story text
-        suggested_style = (await chain.ainvoke({"story_text": story})).strip()
-        # Force flush logs to ensure they're sent immediately
-        import sys
-        sys.stdout.flush()
-        sys.stderr.flush()
+        suggested_style = str(response.get("overall_style") or "").strip()
         # Basic validation: ensure it starts with a space
         if suggested_style and not suggested_style.startswith(" "):
              suggested_style = " " + suggested_style # Add prefix if missing
-
         log.append(f"Suggested overall style: '{suggested_style}'")
-        log_message(f"Suggested overall style: '{suggested_style}'")
-
+        log_message(state, f"Suggested overall style: '{suggested_style}'")
     except Exception as e:
-        log.append(f"Error determining overall style: {e}")
-        log_message(f"Error determining overall style: {e}")
-        suggested_style = " illustration" # Fallback style on error
+        log.append(f"Error determining style: {e}")
+        log_message(state, f"Error determining style: {e}")
 
     # Ensure a fallback style if suggestion is empty or just the prefix
     if not suggested_style or suggested_style == " ":
         suggested_style = " illustration" # Default fallback style
         log.append(f"Using fallback style: '{suggested_style}'")
-        log_message(f"Using fallback style: '{suggested_style}'")
+        log_message(state, f"Using fallback style: '{suggested_style}'")
+
+    return {
+        "characters": characters_found,
+        "scenes": scenes_found,
+        "overall_style": suggested_style,
+        "processing_log": log
+    }
+
+
+async def generate_missing_descriptions(state: StoryAnalysisState) -> StoryAnalysisState:
+    """
+    Node to generate descriptions for characters identified without one using Gemini (via Langchain).
+    """
+    log = state.get("processing_log", [])
+    log.append("Checking for and generating missing descriptions using Gemini...")
+    log_message(state, "--- Generating Missing Descriptions (using Gemini) ---")
+    characters = state.get("characters", {})
+    if not isinstance(characters, dict):
+        characters = {}
+    story = state["story_text"]
 
+    # One pass over the characters, updating them in place: fix up bad entries, fill in
+    # descriptions generated before for the same story, and collect the rest for the model.
+    # The story is only hashed once a character turns out to need a description
+    story_digest = None
+    characters_to_generate = []
+    for name, details in characters.items():
+        # Handle cases where the character entry might not be a dict (e.g., due to parsing error)
+        if not isinstance(details, dict):
+             log.append(f"Skipping description generation for '{name}' due to unexpected format: {details}")
+             log_message(state, f"Warning: Skipping description generation for '{name}' due to unexpected format.")
+             # Ensure the entry is a dict for consistency, even if description remains missing
+             characters[name] = {"description": ""}
+             continue
+        # Check if description is missing/empty
+        if details.get("description", "").strip():
+            continue
+        # Reuse a description generated for the same character of the same story
+        if story_digest is None:
+            story_digest = hashlib.blake2b(story.encode(), digest_size=16).digest()
+        cached_desc = _description_cache.get((story_digest, name))
+        if cached_desc is None:
+            characters_to_generate.append(name)
+            continue
+        details["description"] = cached_desc
+        log.append(f"Reused cached description for {name}.")
+        log_message(state, f"Reused cached description for {name}: {cached_desc}")
+
+    if not characters_to_generate:
+        log.append("No missing descriptions to generate.")
+        log_message(state, "No missing descriptions to generate.")
+        # Ensure the returned state always includes the characters dict
+        return {"characters": characters, "processing_log": log}
+
+    chain = CHARACTER_DESCRIPTIONS_PROMPT | state["llm"] | JSON_PARSER
+    llm_rate_limiter = state["llm_rate_limiter"]
 
-    return {"overall_style": suggested_style, "processing_log": log}
+    log_message(state, f"Attempting to generate descriptions for: {', '.join(characters_to_generate)}")
+    try:
+        # Invoke the chain
+        generated_descs = await call_rate_limited(llm_rate_limiter, lambda: chain.ainvoke({
+            "character_names": ", ".join(f"'{name}'" for name in characters_to_generate),
+            "story_context": story # Provide the full story as context
+        }))
+    except Exception as e:
+        log.append(f"Error generating descriptions: {e}")
+        log_message(state, f"Error generating descriptions: {e}")
+        generated_descs = {}
+
+    for name in characters_to_generate:
+        generated_desc = generated_descs.get(name) if isinstance(generated_descs, dict) else None
+        if isinstance(generated_desc, str) and generated_desc.strip():
+            characters[name]["description"] = generated_desc.strip()
+            _description_cache[(story_digest, name)] = generated_desc.strip()
+            if len(_description_cache) > DESCRIPTION_CACHE_SIZE:
+                _description_cache.pop(next(iter(_description_cache)), None)
+            log.append(f"Successfully generated description for {name}.")
+            log_message(state, f"Generated description for {name}: {generated_desc.strip()}")
+        else:
+            log.append(f"Error generating description for {name}: no description returned")
+            log_message(state, f"Error generating description for {name}: no description returned")
+            # Optionally set a default error description
+            characters[name]["description"] = "Error generating description."
+
+    return {"characters": characters, "processing_log": log}
 
 
 async def generate_image_prompts(state: StoryAnalysisState) -> StoryAnalysisState:
@@ -442,102 +618,106 @@ async def generate_image_prompts(state: StoryAnalysisState) -> StoryAnalysisStat
     """
     log = state.get("processing_log", [])
     log.append("Generating image prompts using Gemini...")
-    log_message("--- Generating Image Prompts (using Gemini) ---")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
+    log_message(state, "--- Generating Image Prompts (using Gemini) ---")
     scenes = state.get("scenes", [])
     characters_info = state.get("characters", {})
     # Get the determined overall style from the state
     overall_style = state.get("overall_style")
-    updated_scenes = []
+    llm = state.get("llm")
+    llm_rate_limiter = state.get("llm_rate_limiter")
 
     if not llm:
         log.append("LLM not available. Skipping image prompt generation.")
-        log_message("LLM not available. Skipping image prompt generation.")
+        log_message(state, "LLM not available. Skipping image prompt generation.")
         return {"scenes": scenes, "processing_log": log}
 
     # Use a default style if none was determined or passed
     if not overall_style:
         overall_style = " illustration" # Default fallback style
         log.append(f"Overall style not found in state, using fallback: '{overall_style}'")
-        log_message(f"Overall style not found in state, using fallback: '{overall_style}'")
+        log_message(state, f"Overall style not found in state, using fallback: '{overall_style}'")
 
-    log_message(f"Using overall style for prompts: '{overall_style}'")
+    log_message(state, f"Using overall style for prompts: '{overall_style}'")
 
-    prompt_template = ChatPromptTemplate.from_messages([
-        ("system", """You are an expert prompt engineer for text-to-image models.
-Based on the provided scene details, create a concise yet descriptive prompt suitable for generating an image.
-The prompt should capture the essence of the scene: the environment, characters (incorporating their descriptions), actions, and mood/tone.
-Focus on visual elements. Output ONLY the generated prompt as a plain string.
-"""),
-        ("human", """Generate an image prompt for the following scene:
-Scene Number: {scene_number}
-Summary: {summary}
-Setting: {setting}
-Characters Present: {characters_present}
-Relevant Character Descriptions:
-{relevant_character_descriptions}
-Tone: {tone}""")
-    ])
 
-    parser = StrOutputParser()
-    chain = prompt_template | llm | parser
+    chain = SCENE_IMAGE_PROMPTS_PROMPT | llm | JSON_PARSER
 
-    for scene in scenes:
-        scene_num = scene.get('scene_number', 'N/A')
-        try:
-            present_char_names = scene.get('characters_present', [])
-            relevant_descriptions_list = []
-            if isinstance(characters_info, dict):
-                for name in present_char_names:
-                    char_data = characters_info.get(name)
-                    if isinstance(char_data, dict):
-                        description = char_data.get('description', '').strip()
-                        if description:
-                            relevant_descriptions_list.append(f"- {name}: {description}")
-                        else:
-                            relevant_descriptions_list.append(f"- {name}: (No specific description provided)")
+    log_append = log.append
+    # Bounds the requests in flight for this story
+    request_limiter = asyncio.Semaphore(LLM_REQUEST_CONCURRENCY)
+
+    def describe_scene(scene):
+        present_char_names = scene.get('characters_present', [])
+        relevant_descriptions_list = []
+        if isinstance(characters_info, dict):
+            for name in present_char_names:
+                char_data = characters_info.get(name)
+                if isinstance(char_data, dict):
+                    description = char_data.get('description', '').strip()
+                    if description:
+                        relevant_descriptions_list.append(f"- {name}: {description}")
                     else:
-                         relevant_descriptions_list.append(f"- {name}: (Character data missing)")
+                        relevant_descriptions_list.append(f"- {name}: (No specific description provided)")
+                else:
+                     relevant_descriptions_list.append(f"- {name}: (Character data missing)")
 
-            if not relevant_descriptions_list:
-                 relevant_desc_text = "None specific to this scene."
-            else:
-                 relevant_desc_text = "\n".join(relevant_descriptions_list)
-
-            # Get the base content prompt from the LLM
-            image_prompt_content = await chain.ainvoke({
-                "scene_number": scene_num,
-                "summary": scene.get('summary', ''),
-                "setting": scene.get('setting', ''),
-                "characters_present": ", ".join(present_char_names) if present_char_names else "None",
-                "relevant_character_descriptions": relevant_desc_text,
-                "tone": scene.get('tone', '')
-            })
-            # Force flush logs to ensure they're sent immediately
-            import sys
-            sys.stdout.flush()
-            sys.stderr.flush()
+        if not relevant_descriptions_list:
+             relevant_desc_text = "None specific to this scene."
+        else:
+             relevant_desc_text = "\n".join(relevant_descriptions_list)
 
+        return f"""Scene Number: {scene.get('scene_number', 'N/A')}
+Summary: {scene.get('summary', '')}
+Setting: {scene.get('setting', '')}
+Characters Present: {", ".join(present_char_names) if present_char_names else "None"}
+Relevant Character Descriptions:
+{relevant_desc_text}
+Tone: {scene.get('tone', '')}"""
+
+    async def generate_batch_prompts(batch):
+        scene_nums = ", ".join(str(scene.get('scene_number', 'N/A')) for scene in batch)
+        try:
+            # Get the base content prompts for the whole batch from the LLM
+            async with request_limiter:
+                prompt_contents = await call_rate_limited(llm_rate_limiter, lambda: chain.ainvoke({
+                    "scene_count": len(batch),
+                    "scene_details": "\n\n".join(describe_scene(scene) for scene in batch)
+                }))
+            if not isinstance(prompt_contents, list) or len(prompt_contents) != len(batch):
+                raise ValueError(f"expected a list of {len(batch)} prompts, got {prompt_contents!r}")
+
+        except Exception as e:
+            log_append(f"Error generating image prompts for scenes {scene_nums}: {e}")
+            log_message(state, f"Error generating image prompts for scenes {scene_nums}: {e}")
+            for scene in batch:
+                scene['image_prompt'] = "Error generating image prompt."
+            return
+
+        for scene, image_prompt_content in zip(batch, prompt_contents):
+            scene_num = scene.get('scene_number', 'N/A')
+            # A null or non-text entry must not reach the image model as "None. In the following style ..."
+            if not isinstance(image_prompt_content, str) or not image_prompt_content.strip():
+                log_append(f"Error generating image prompt for scene {scene_num}: got {image_prompt_content!r}")
+                log_message(state, f"Error generating image prompt for scene {scene_num}: got {image_prompt_content!r}")
+                scene['image_prompt'] = "Error generating image prompt."
+                continue
             # Append the determined overall_style
             final_image_prompt = f"{image_prompt_content.strip()}. In the following style {overall_style}"
 
             # Store the final prompt (content + style)
             scene['image_prompt'] = final_image_prompt
-            log.append(f"Generated image prompt for scene {scene_num}.")
+            log_append(f"Generated image prompt for scene {scene_num}.")
             # Print the final prompt being used
-            log_message(f"Generated image prompt for scene {scene_num}: {final_image_prompt}")
-
-        except Exception as e:
-            log.append(f"Error generating image prompt for scene {scene_num}: {e}")
-            log_message(f"Error generating image prompt for scene {scene_num}: {e}")
-            scene['image_prompt'] = "Error generating image prompt."
+            log_message(state, f"Generated image prompt for scene {scene_num}: {final_image_prompt}")
 
-        updated_scenes.append(scene)
+    # One request covers IMAGE_PROMPT_BATCH_SIZE scenes, sharing the instructions and the request budget;
+    # batches are independent, so their requests overlap. Each scene dict is updated in place
+    await asyncio.gather(*(
+        generate_batch_prompts(scenes[start:start + IMAGE_PROMPT_BATCH_SIZE])
+        for start in range(0, len(scenes), IMAGE_PROMPT_BATCH_SIZE)
+    ))
 
-    return {"scenes": updated_scenes, "processing_log": log}
+    return {"scenes": scenes, "processing_log": log}
 
 
 async def generate_images_for_scenes(state: StoryAnalysisState) -> StoryAnalysisState:
@@ -547,49 +727,42 @@ async def generate_images_for_scenes(state: StoryAnalysisState) -> StoryAnalysis
     """
     log = state.get("processing_log", [])
     log.append("Generating images using Google GenAI...")
-    log_message("--- Generating Images (using Google GenAI) ---")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
+    log_message(state, "--- Generating Images (using Google GenAI) ---")
     scenes = state.get("scenes", [])
-    updated_scenes = []
+    genai_client = state.get("genai_client")
+    image_rate_limiter = state.get("image_rate_limiter")
 
     # Ensure the GenAI client was initialized
     if not genai_client:
          log.append("Google GenAI Image Generation client not available. Skipping image generation.")
-         log_message("⚠️ Google GenAI Image Generation client not available. Skipping image generation.")
-         # Add existing scenes back without image URLs
+         log_message(state, "⚠️ Google GenAI Image Generation client not available. Skipping image generation.")
+         # Hand the scenes back without images
          for scene in scenes:
-             scene['image_base64'] = None
-             updated_scenes.append(scene)
-         return {"scenes": updated_scenes, "processing_log": log}
+             scene['image_bytes'] = None
+         return {"scenes": scenes, "processing_log": log}
 
+    log_append = log.append
+    # Bounds the image requests in flight for this story
+    request_limiter = asyncio.Semaphore(IMAGE_REQUEST_CONCURRENCY)
 
-    for scene in scenes:
+    async def generate_scene_image(scene):
         image_prompt = scene.get('image_prompt')
         scene_num = scene.get('scene_number', 'N/A')
-        generated_image_base64  = None # Initialize path for this scene
+        generated_image_bytes  = None # Initialize path for this scene
 
         if image_prompt and "Error" not in image_prompt:
-            log_message(f"Attempting image generation for scene {scene_num}...")
             try:
-                # Use the prompt directly as contents
-                contents = image_prompt
-
-                # Call the Google GenAI API for image generation using client.models.generate_content
-                response = genai_client.models.generate_content(
-                            model="gemini-2.0-flash-exp-image-generation", # Specific model for image generation
-                            contents=contents,
-                            config=types.GenerateContentConfig(
-                              response_modalities=['Text', 'Image'], # Both Text and Image as per https://ai.google.dev/gemini-api/docs/image-generation#gemini
-                            )
+                async with request_limiter:
+                    log_message(state, f"Attempting image generation for scene {scene_num}...")
+                    # Call the Google GenAI API for image generation using the client's native async
+                    # models.generate_content, so the scenes' requests share the event loop without worker threads
+                    response = await call_rate_limited(image_rate_limiter, lambda: genai_client.aio.models.generate_content(
+                        model="gemini-2.0-flash-exp-image-generation", # Specific model for image generation
+                        contents=image_prompt, # Use the prompt directly as contents
+                        config=types.GenerateContentConfig(
+                          response_modalities=['Text', 'Image'], # Both Text and Image as per https://ai.google.dev/gemini-api/docs/image-generation#gemini
                         )
-                await asyncio.sleep(8) #Gemini-2.0-flash has rate limit of 10 per minute
-                # Force flush logs to ensure they're sent immediately
-                import sys
-                sys.stdout.flush()
-                sys.stderr.flush()
+                    ))
                 # Process the response to find and save the image
                 image_saved = False
                 # Check if candidates exist and have content parts
@@ -597,41 +770,45 @@ async def generate_images_for_scenes(state: StoryAnalysisState) -> StoryAnalysis
                     for part in response.candidates[0].content.parts:
                         # Check if the part has inline_data and if that data has a 'data' attribute
                         if hasattr(part, 'inline_data') and hasattr(part.inline_data, 'data'):
-                            log_message(f"Image data received for scene {scene_num}.")
+                            log_message(state, f"Image data received for scene {scene_num}.")
                             image_data = part.inline_data.data
                             try:
-                            
-                               
+                                # google-genai already hands back decoded bytes; older clients and raw
+                                # REST responses give base64 text, which is decoded once here
+                                if isinstance(image_data, str):
+                                    image_data = base64.b64decode(image_data)
                                 # Save the image
-                                generated_image_base64 = image_data
-                                log_message(f"Saved image for scene {scene_num}")
-                                log.append(f"Generated and saved image for scene {scene_num}")
+                                generated_image_bytes = image_data
+                                log_message(state, f"Saved image for scene {scene_num}")
+                                log_append(f"Generated and saved image for scene {scene_num}")
                                 image_saved = True
                                 break # Assuming only one image part per scene
                             except Exception as img_err:
-                                log.append(f"Error processing/saving image data for scene {scene_num}: {img_err}")
-                                log_message(f"Error processing/saving image data for scene {scene_num}: {img_err}")
-                                # Keep generated_image_base64 as None
+                                log_append(f"Error processing/saving image data for scene {scene_num}: {img_err}")
+                                log_message(state, f"Error processing/saving image data for scene {scene_num}: {img_err}")
+                                # Keep generated_image_bytes as None
 
                 if not image_saved:
-                     log.append(f"No valid image data found or saved in response for scene {scene_num}.")
-                     log_message(f"Warning: No valid image data found or saved in API response for scene {scene_num}.")
+                     log_append(f"No valid image data found or saved in response for scene {scene_num}.")
+                     log_message(state, f"Warning: No valid image data found or saved in API response for scene {scene_num}.")
 
             except Exception as e:
-                log.append(f"Error during image generation API call for scene {scene_num}: {e}")
-                log_message(f"Error during image generation API call for scene {scene_num}: {e}")
-                # Keep generated_image_base64 as None
+                log_append(f"Error during image generation API call for scene {scene_num}: {e}")
+                log_message(state, f"Error during image generation API call for scene {scene_num}: {e}")
+                # Keep generated_image_bytes as None
 
         else:
-            log.append(f"Skipping image generation for scene {scene_num} due to missing or error in prompt.")
-            log_message(f"Skipping image generation for scene {scene_num} (invalid prompt).")
-            # Keep generated_image_base64 as None
+            log_append(f"Skipping image generation for scene {scene_num} due to missing or error in prompt.")
+            log_message(state, f"Skipping image generation for scene {scene_num} (invalid prompt).")
+            # Keep generated_image_bytes as None
 
         # Update the scene info with the file path (or None if failed)
-        scene['image_base64'] = generated_image_base64 
-        updated_scenes.append(scene)
+        scene['image_bytes'] = generated_image_bytes
+
+    # Scenes are independent, so their requests overlap; each scene dict is updated in place
+    await asyncio.gather(*(generate_scene_image(scene) for scene in scenes))
 
-    return {"scenes": updated_scenes, "processing_log": log}
+    return {"scenes": scenes, "processing_log": log}
 
 # ---  Audio Generation ---
 
@@ -642,83 +819,69 @@ async def generate_audio_for_scenes(state: StoryAnalysisState) -> StoryAnalysisS
     """
     log = state.get("processing_log", [])
     log.append("Generating audio ...")
-    log_message("--- Generating Audio ---")
-    # Force flush logs to ensure they're sent immediately
-    import sys
-    sys.stdout.flush()
-    sys.stderr.flush()
+    log_message(state, "--- Generating Audio ---")
     scenes = state.get("scenes", [])
-    updated_scenes = []
 
-    # Create an output directory if it doesn't exist
+    log_append = log.append
+    loop = asyncio.get_running_loop()
 
-    for scene in scenes:
+    async def generate_scene_audio(scene):
         scene_text = scene.get('scene_text')
         scene_num = scene.get('scene_number', 'N/A')
         generated_audio_array = None # Initialize path for this scene
 
         if scene_text:
-            log_message(f"Audio generation for scene {scene_num}...")
             try:
-                
-                generated_audio_array = tts_model.tts(scene_text)    
-                
-                # Force flush logs to ensure they're sent immediately
-                import sys
-                sys.stdout.flush()
-                sys.stderr.flush()    
-                
-
-                # ==========================================================
-
-                log_message(f"Saving audio for scene {scene_num}")
-                log.append(f"Audio generation for scene {scene_num}.")
-                
-                # Force flush logs to ensure they're sent immediately
-                import sys
-                sys.stdout.flush()
-                sys.stderr.flush()
-                
-                # Yield control to allow event loop to process log streaming
-                await asyncio.sleep(0.01)
+                log_message(state, f"Audio generation for scene {scene_num}...")
+                generated_audio_array = await loop.run_in_executor(TTS_POOL, tts_model.tts, scene_text)
+
+                log_message(state, f"Saving audio for scene {scene_num}")
+                log_append(f"Audio generation for scene {scene_num}.")
 
             except Exception as e:
-                log.append(f"Error during audio generation for scene {scene_num}: {e}")
-                log_message(f"Error during audio generation for scene {scene_num}: {e}")
+                log_append(f"Error during audio generation for scene {scene_num}: {e}")
+                log_message(state, f"Error during audio generation for scene {scene_num}: {e}")
                 generated_audio_array = None # Indicate failure
         else:
-            log.append(f"Skipping audio generation for scene {scene_num} due to missing scene text.")
-            log_message(f"Skipping audio generation for scene {scene_num} (missing text).")
+            log_append(f"Skipping audio generation for scene {scene_num} due to missing scene text.")
+            log_message(state, f"Skipping audio generation for scene {scene_num} (missing text).")
             generated_audio_array = None # Ensure path is None if text is missing
 
         # Update the scene info with the file path (or None if failed)
         scene['audio_array'] = generated_audio_array
-        updated_scenes.append(scene)
 
-    return {"scenes": updated_scenes, "processing_log": log}
+    # Scenes are synthesized side by side on TTS_POOL; each scene dict is updated in place
+    await asyncio.gather(*(generate_scene_audio(scene) for scene in scenes))
+
+    return {"scenes": scenes, "processing_log": log}
+
+async def generate_media_for_scenes(state: StoryAnalysisState) -> StoryAnalysisState:
+    """
+    Node to generate the images and the audio for the scenes at the same time.
+
+    Audio only needs the scene text, so it doesn't wait for the images. Each
+    side writes its own key of the shared scene dicts ('image_bytes' and
+    'audio_array'), so both can work on the same scene list.
+    """
+    await asyncio.gather(generate_images_for_scenes(state), generate_audio_for_scenes(state))
+    return {"scenes": state.get("scenes", []), "processing_log": state.get("processing_log", [])}
 
 def create_graph():
     workflow = StateGraph(StoryAnalysisState)
     # Add the nodes
     workflow.add_node("read_story", read_story)
-    workflow.add_node("analyze_characters", analyze_characters)
+    workflow.add_node("analyze_story", analyze_story)
     workflow.add_node("generate_descriptions", generate_missing_descriptions)
-    workflow.add_node("analyze_scenes", analyze_scenes)
-    workflow.add_node("determine_style", determine_overall_style)
     workflow.add_node("generate_image_prompts", generate_image_prompts)
-    workflow.add_node("generate_images", generate_images_for_scenes)
-    workflow.add_node("generate_audio", generate_audio_for_scenes) 
+    workflow.add_node("generate_media", generate_media_for_scenes)
 
     # Define the edges (flow)
     workflow.set_entry_point("read_story")
-    workflow.add_edge("read_story", "analyze_characters")
-    workflow.add_edge("analyze_characters", "generate_descriptions")
-    workflow.add_edge("generate_descriptions", "analyze_scenes")
-    workflow.add_edge("analyze_scenes", "determine_style")
-    workflow.add_edge("determine_style", "generate_image_prompts")
-    workflow.add_edge("generate_image_prompts", "generate_images")
-    workflow.add_edge("generate_images", "generate_audio") 
-    workflow.add_edge("generate_audio", END) 
+    workflow.add_edge("read_story", "analyze_story")
+    workflow.add_edge("analyze_story", "generate_descriptions")
+    workflow.add_edge("generate_descriptions", "generate_image_prompts")
+    workflow.add_edge("generate_image_prompts", "generate_media")
+    workflow.add_edge("generate_media", END)
 
     # Compile the graph
     graph = workflow.compile()